@@ -0,0 +1,192 @@
+# Books random stays on a handful of listings from many threads at once
+# through bookings.claim_stay, then checks that no night ended up with more
+# than one live booking, that every stay that went through got all of its
+# nights and that none failed with a database error (such as a deadlock that
+# outlasted claim_stay's retries). Adds a synthetic host with --listings listings of --nights open
+# nights each, and --threads renters, so only point it at a scratch database.
+#
+#   poetry run python -m benchmarks.booking_contention [--threads 32] [--attempts 100]
+
+import argparse
+import random
+import statistics
+import sys
+import threading
+import time
+from datetime import date, timedelta
+
+from mysql.connector.errors import DatabaseError
+from wtforms.validators import ValidationError
+
+from mybnb import db, listing_calendars
+from mybnb.db import query, transaction, release
+from mybnb.tables import booking_slots, bookings
+
+# Longest stay tried, in nights
+MAX_STAY = 4
+
+def populate(listing_count: int, nights: int, renter_count: int, seed: int):
+    generator = random.Random(seed)
+    suffix = generator.randrange(10 ** 6)
+    first_night = date.today() + timedelta(days=1)
+
+    with transaction():
+        host_id = query(
+            '''
+                INSERT INTO Users(sin, username, name, dob)
+                VALUES (%(sin)s, %(username)s, 'Benchmark Host', '1970-01-01')
+            ''',
+            sin=800000000 + suffix,
+            username=f'contention-host-{suffix}'
+        ).lastrowid
+        query('INSERT INTO Hosts(user_id) VALUES (%(host_id)s)', host_id=host_id)
+
+        renter_ids = []
+        for idx in range(renter_count):
+            renter_id = query(
+                '''
+                    INSERT INTO Users(sin, username, name, dob)
+                    VALUES (%(sin)s, %(username)s, 'Benchmark Renter', '1970-01-01')
+                ''',
+                sin=700000000 + suffix * 100 + idx,
+                username=f'contention-renter-{suffix}-{idx}'
+            ).lastrowid
+            query(
+                "INSERT INTO Renters(user_id, card_num) VALUES (%(renter_id)s, '4000000000000000')",
+                renter_id=renter_id
+            )
+            renter_ids.append(renter_id)
+
+        listing_ids = [
+            query(
+                '''
+                    INSERT INTO Listings(owner_id, country, city, postal, address, lat, lon, type, amenities)
+                    VALUES (%(host_id)s, 'Canada', 'Toronto', 'M5V1A1', %(address)s, 43.65, -79.38, 'Apartment', '')
+                ''',
+                host_id=host_id,
+                address=f'{idx} Contention St'
+            ).lastrowid
+            for idx in range(listing_count)
+        ]
+        booking_slots.add_ranges(
+            (listing_id, first_night, first_night + timedelta(days=nights - 1))
+            for listing_id in listing_ids
+        )
+        query(
+            f'''
+                INSERT INTO Availability(slot_id, rental_price)
+                SELECT id, 100
+                FROM BookingSlots
+                WHERE listing_id IN ({', '.join(str(listing_id) for listing_id in listing_ids)})
+            '''
+        )
+        listing_calendars.refresh_listing_ids(listing_ids)
+
+    return (listing_ids, renter_ids, first_night)
+
+def book_randomly(renter_id, listing_ids, first_night: date, nights: int, attempts: int, seed: int, outcomes: list):
+    generator = random.Random(seed)
+    last_night = first_night + timedelta(days=nights - 1)
+    for _ in range(attempts):
+        listing_id = generator.choice(listing_ids)
+        start = first_night + timedelta(days=generator.randrange(nights))
+        end = min(start + timedelta(days=generator.randrange(MAX_STAY)), last_night)
+
+        started = time.perf_counter()
+        try:
+            booked = bookings.claim_stay(listing_id, start, end, renter_id)
+            outcomes.append(('booked', booked, time.perf_counter() - started))
+        except ValidationError:
+            outcomes.append(('taken', 0, time.perf_counter() - started))
+        except DatabaseError as e:
+            # Deadlocks left after the retries and lock wait timeouts
+            outcomes.append((f'error {e.errno}', 0, time.perf_counter() - started))
+        finally:
+            release()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--attempts', type=int, default=100, help='stays each thread tries to book')
+    parser.add_argument('--listings', type=int, default=4)
+    parser.add_argument('--nights', type=int, default=60, help='open nights per listing')
+    parser.add_argument('--seed', type=int, default=43)
+    args = parser.parse_args()
+
+    # A connection per booker, so that they really do contend in the database
+    db.pool = db.ConnectionPool(args.threads, **db.CONNECT_ARGS)
+
+    try:
+        (listing_ids, renter_ids, first_night) = populate(args.listings, args.nights, args.threads, args.seed)
+    finally:
+        release()
+
+    outcomes = []
+    threads = [
+        threading.Thread(
+            target=book_randomly,
+            args=(renter_id, listing_ids, first_night, args.nights, args.attempts, args.seed + idx, outcomes)
+        )
+        for (idx, renter_id) in enumerate(renter_ids)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    try:
+        listing_ids_sql = ', '.join(str(listing_id) for listing_id in listing_ids)
+        double_booked = query(
+            f'''
+                SELECT S.id
+                FROM BookingSlots S
+                JOIN Availability A ON A.slot_id = S.id
+                JOIN BookingsLive B ON B.availability_id = A.id
+                WHERE S.listing_id IN ({listing_ids_sql})
+                GROUP BY S.id
+                HAVING COUNT(*) > 1
+            '''
+        ).rowcount
+        booked_nights = query(
+            f'''
+                SELECT COUNT(*) AS count
+                FROM BookingSlots S
+                JOIN Availability A ON A.slot_id = S.id
+                JOIN BookingsLive B ON B.availability_id = A.id
+                WHERE S.listing_id IN ({listing_ids_sql})
+            '''
+        ).fetchone().count
+        calendar_differences = [
+            difference
+            for difference in listing_calendars.check()
+            if any(difference.startswith(f'Listing {listing_id}:') for listing_id in listing_ids)
+        ]
+    finally:
+        release()
+
+    counts = {}
+    for (outcome, _, _) in outcomes:
+        counts[outcome] = counts.get(outcome, 0) + 1
+    claimed_nights = sum(nights for (_, nights, _) in outcomes)
+    latencies = sorted(seconds for (_, _, seconds) in outcomes)
+
+    print(f'{len(outcomes)} attempts by {args.threads} threads in {elapsed:.2f}s: {len(outcomes) / elapsed:.0f} attempts/s')
+    print(', '.join(f'{count} {outcome}' for (outcome, count) in sorted(counts.items())))
+    print(f'Latency: median {statistics.median(latencies) * 1000:.1f}ms, '
+          f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms')
+    print(f'{booked_nights} nights booked of {args.listings * args.nights}; {double_booked} double booked')
+
+    if double_booked or booked_nights != claimed_nights or calendar_differences:
+        for difference in calendar_differences:
+            print(difference)
+        sys.exit(f'Bookings are inconsistent: {claimed_nights} nights were claimed, '
+                 f'{booked_nights} are booked and {double_booked} are double booked.')
+
+    errors = sum(count for (outcome, count) in counts.items() if outcome.startswith('error'))
+    if errors:
+        sys.exit(f'{errors} of {len(outcomes)} attempts failed with a database error.')
+
+if __name__ == '__main__':
+    main()
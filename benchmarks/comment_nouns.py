@@ -0,0 +1,100 @@
+# Tags synthetic listing comments with comment_nouns.tag_chunks at increasing
+# worker counts and checks the output against find_noun_phrases.
+#
+# With --check-report-cache, it instead generates a background report (whose
+# noun phrase sections refresh the noun cache) against the database, then
+# requests the same report again and checks that it is handed out from the
+# cache, i.e. that the refresh didn't count as a write.
+#
+#   poetry run python -m benchmarks.comment_nouns [--comments N] [--chunk-size N]
+#   poetry run python -m benchmarks.comment_nouns --check-report-cache
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import date, timedelta
+
+from mybnb import comment_nouns
+
+PHRASES = [
+    'The apartment was clean and the host was very friendly.',
+    'Great location near the subway, but the kitchen was small.',
+    'Wifi kept dropping and the heating did not work at night.',
+    'Lovely view of the lake from the balcony; the beds were comfy.',
+    'Check-in was easy and the neighbourhood felt safe.',
+    'The bathroom needs repairs, and there was noise from the street.',
+    'Perfect for a weekend trip with friends, would book again!',
+    'Parking was free and the host left us coffee and breakfast.',
+]
+
+def synthetic_comments(count: int, seed: int = 43):
+    generator = random.Random(seed)
+    return [
+        ' '.join(generator.sample(PHRASES, generator.randint(1, 3)))[:511]
+        for _ in range(count)
+    ]
+
+def chunked(texts, chunk_size):
+    return [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+
+def check_report_cache():
+    from mybnb import background_reports, db
+
+    (start_date, end_date) = (date.today(), date.today() + timedelta(days=30))
+    version = db.data_version()
+    first = background_reports.submit(start_date, end_date)
+    db.release()
+    while not (report := background_reports.get(first)).done:
+        db.release()
+        time.sleep(0.5)
+    if report.error:
+        sys.exit(f'Report failed: {report.error}')
+
+    second = background_reports.submit(start_date, end_date)
+    version_after = db.data_version()
+    db.release()
+    if second != first:
+        sys.exit(f'The repeated report was generated again (data version {version} -> {version_after}).')
+    print(f'The repeated report was a cache hit (data version {version_after}).')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=comment_nouns.CHUNK_SIZE)
+    parser.add_argument('--check-report-cache', action='store_true', help='check that a repeated report is reused')
+    args = parser.parse_args()
+
+    if args.check_report_cache:
+        check_report_cache()
+        return
+
+    texts = synthetic_comments(args.comments)
+
+    started = time.perf_counter()
+    expected = [comment_nouns.find_noun_phrases(text) for text in texts]
+    baseline = time.perf_counter() - started
+    expected_counts = Counter(noun for nouns in expected for noun in nouns if noun)
+    print(f'{len(texts)} comments, chunks of {args.chunk_size}')
+    print(f'find_noun_phrases, sequential: {baseline:.2f}s')
+
+    workers = 1
+    while True:
+        started = time.perf_counter()
+        nouns, counts = [], Counter()
+        for tagged in comment_nouns.tag_chunks(chunked(texts, args.chunk_size), workers=workers):
+            nouns.extend(tagged.nouns)
+            counts.update(tagged.counts)
+        elapsed = time.perf_counter() - started
+
+        assert nouns == expected and counts == expected_counts, f'output differs with {workers} workers'
+        print(f'{workers:>3} workers: {elapsed:.2f}s ({baseline / elapsed:.2f}x)')
+
+        if workers >= (os.cpu_count() or 1):
+            break
+        workers = min(workers * 2, os.cpu_count() or 1)
+
+if __name__ == '__main__':
+    main()
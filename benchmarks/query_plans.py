@@ -0,0 +1,286 @@
+# Index advisor and query plan regression check. Drives the app's pages,
+# searches and reports against the database, captures one statement of every
+# query shape it issues (see instrumentation.capture_samples), EXPLAINs each
+# and flags full table scans and filesorts. With --update, the flagged plans
+# are recorded in query_plans.json as accepted; otherwise the run fails if a
+# query shape is flagged for anything not recorded there, e.g. because an
+# index went missing or a query stopped using it. The committed file accepts
+# nothing, so any flagged plan fails the run until it has been reviewed and
+# accepted (or fixed with an index).
+#
+# Plans depend on table sizes, so run it against a scratch database with a
+# realistic amount of data; --populate adds a synthetic host with that many
+# open nights, renters and bookings first.
+#
+# With --check-indexes, each index in INDEXES is also made invisible in turn
+# and the plans explained again, to confirm that it removes a flagged scan or
+# sort; one that removes nothing is reported, and fails the run.
+#
+#   poetry run python -m benchmarks.query_plans --populate 200000 --update
+#   poetry run python -m benchmarks.query_plans [--check-indexes]
+
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import date, timedelta
+from pathlib import Path
+
+# Before the app is imported, so that driving it leaves no session files
+# behind
+os.environ.setdefault('MYBNB_SESSION_STORE', 'cookie')
+os.environ.setdefault('MYBNB_SECRET_KEY', os.urandom(32).hex())
+
+from mysql.connector.errors import Error as MySQLError
+
+from benchmarks import search_index as search_benchmark
+from mybnb import booking_rollups, instrumentation, listing_calendars, price_stats, reports, report_runner
+from mybnb.app import app
+from mybnb.db import query, transaction, release
+from mybnb.tables import listings
+
+BASELINE = Path(__file__).with_name('query_plans.json')
+
+EXPLAINABLE = {'SELECT', 'WITH', 'INSERT', 'REPLACE', 'UPDATE', 'DELETE'}
+
+# Scans of tables smaller than this many rows aren't worth flagging
+MIN_ROWS = 1000
+
+# Indexes added on this tool's advice, as (table, index) in sql/create.sql
+INDEXES = [
+    ('Listings', 'ListingsPlace'),
+    ('BookingSlots', 'BookingSlotsDate'),
+    ('Availability', 'AvailabilitySlot'),
+    ('Bookings', 'BookingsAvailability'),
+    ('Bookings', 'BookingsRenter'),
+]
+
+def populate(nights: int, renter_count: int, seed: int):
+    (host_id, listing_ids) = search_benchmark.populate(nights, 60, seed)
+
+    generator = random.Random(seed)
+    suffix = generator.randrange(10 ** 6)
+    with transaction():
+        renter_ids = []
+        for idx in range(renter_count):
+            renter_id = query(
+                '''
+                    INSERT INTO Users(sin, username, name, dob)
+                    VALUES (%(sin)s, %(username)s, 'Plan Renter', '1970-01-01')
+                ''',
+                sin=600000000 + suffix * 100 + idx,
+                username=f'plan-renter-{suffix}-{idx}'
+            ).lastrowid
+            query(
+                "INSERT INTO Renters(user_id, card_num) VALUES (%(renter_id)s, '4000000000000000')",
+                renter_id=renter_id
+            )
+            renter_ids.append(renter_id)
+
+        # A fifth of the nights booked, spread over the renters, and a tenth
+        # of those bookings cancelled
+        for (idx, renter_id) in enumerate(renter_ids):
+            query(
+                f'''
+                    INSERT INTO Bookings(availability_id, renter_id)
+                    SELECT A.id, %(renter_id)s
+                    FROM Availability A
+                    JOIN BookingSlots S ON S.id = A.slot_id
+                    WHERE
+                        S.listing_id IN ({', '.join(str(listing_id) for listing_id in listing_ids)}) AND
+                        MOD(A.id, %(renter_count)s) = %(idx)s AND
+                        RAND(%(seed)s) < 0.2
+                ''',
+                renter_id=renter_id,
+                renter_count=renter_count,
+                idx=idx,
+                seed=seed + idx
+            )
+        query(
+            f'''
+                UPDATE Bookings
+                SET
+                    cancelled = 1
+                WHERE
+                    renter_id IN ({', '.join(str(renter_id) for renter_id in renter_ids)}) AND
+                    MOD(id, 10) = 0
+            '''
+        )
+
+    booking_rollups.rebuild()
+    price_stats.rebuild()
+    listing_calendars.rebuild()
+
+def sample_ids():
+    # A host with listings and a renter with bookings to act as
+    row = query(
+        '''
+            SELECT L.owner_id AS host_id, L.id AS listing_id, S.id AS slot_id, B.renter_id
+            FROM Bookings B
+            JOIN Availability A ON A.id = B.availability_id
+            JOIN BookingSlots S ON S.id = A.slot_id
+            JOIN Listings L ON L.id = S.listing_id
+            WHERE NOT B.cancelled
+            ORDER BY B.id DESC
+            LIMIT 1
+        '''
+    ).fetchone()
+    if not row:
+        sys.exit('There are no bookings to drive the app with; run with --populate first.')
+    return row
+
+def drive(seed: int):
+    ids = sample_ids()
+    client = app.test_client()
+
+    def visit(user_id, *paths):
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+        for path in paths:
+            client.get(path)
+
+    visit(
+        ids.host_id,
+        '/dashboard', '/my-profile', '/my-listings', '/my-listings/pricing',
+        f'/my-listings/{ids.listing_id}/edit',
+        f'/my-listings/{ids.listing_id}/schedule',
+        f'/my-listings/{ids.listing_id}/schedule/{ids.slot_id}/info',
+        f'/my-listings/{ids.listing_id}/schedule/{ids.slot_id}/set-price',
+        f'/my-listings/{ids.listing_id}/schedule/{ids.renter_id}/rate-renter',
+        '/reports',
+    )
+    visit(
+        ids.renter_id,
+        '/dashboard', '/my-rentals', '/listings',
+        f'/my-rentals/{ids.listing_id}/rate',
+        f'/my-rentals/{ids.host_id}/rate-host',
+    )
+
+    # Searches of every shape the search form makes, per night and grouped
+    generator = random.Random(seed)
+    with app.test_request_context():
+        for _ in range(200):
+            filters = search_benchmark.random_filters(generator)
+            listings.search(ids.renter_id, filters)
+            listings.search_grouped(ids.renter_id, filters)
+
+    # Every report section, over the coming month
+    report_runner.run(reports.report_jobs(date.today(), date.today() + timedelta(days=30)))
+
+def explain(sql: str, env: dict) -> list:
+    return query(f'EXPLAIN {sql}', **env).fetchall()
+
+def findings(plan: list, min_rows: int) -> list[str]:
+    flagged = set()
+    for step in plan:
+        # Derived tables and unions (<derived2>, <union1,2>) are scanned by
+        # design; their own plans are further down the same EXPLAIN
+        if not step.table or step.table.startswith('<'):
+            continue
+        if step.type == 'ALL' and (step.rows or 0) >= min_rows:
+            flagged.add(f'full scan of {step.table}')
+        if step.Extra and 'Using filesort' in step.Extra:
+            flagged.add(f'filesort of {step.table}')
+    return sorted(flagged)
+
+def explain_all(captured: dict, min_rows: int) -> tuple[dict, list[str]]:
+    # ({fingerprint: {'caller', 'findings'}} of the flagged plans, notes on
+    # the statements that couldn't be explained)
+    flagged = {}
+    unexplained = []
+    for (fingerprint, (sql, env, caller)) in sorted(captured.items(), key=lambda item: item[1][2]):
+        # Not DDL, SET, LOCK TABLES and the like
+        if sql.split(None, 1)[0].upper() not in EXPLAINABLE:
+            continue
+        try:
+            plan = explain(sql, env)
+        except MySQLError as e:
+            # E.g. statements on temporary tables that are gone by now
+            unexplained.append(f'{caller}: {e.msg}')
+            continue
+        found = findings(plan, min_rows)
+        if found:
+            flagged[fingerprint] = {'caller': caller, 'findings': found}
+    return (flagged, unexplained)
+
+def check_indexes(captured: dict, flagged: dict, min_rows: int) -> list[str]:
+    # What each index of INDEXES removes from the flagged plans; returns the
+    # indexes that remove nothing
+    useless = []
+    for (table, index) in INDEXES:
+        try:
+            query(f'ALTER TABLE {table} ALTER INDEX {index} INVISIBLE')
+        except MySQLError as e:
+            print(f'{table}.{index}: could not be hidden ({e.msg})')
+            continue
+        try:
+            (without, _) = explain_all(captured, min_rows)
+        finally:
+            query(f'ALTER TABLE {table} ALTER INDEX {index} VISIBLE')
+
+        removed = [
+            f"{entry['caller']}: {finding}"
+            for (fingerprint, entry) in without.items()
+            for finding in entry['findings']
+            if finding not in flagged.get(fingerprint, {}).get('findings', [])
+        ]
+        if removed:
+            print(f'{table}.{index} removes:\n    ' + '\n    '.join(removed))
+        else:
+            print(f'{table}.{index} removes no flagged scan or sort.')
+            useless.append(f'{table}.{index}')
+    return useless
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--populate', type=int, default=0, metavar='NIGHTS')
+    parser.add_argument('--renters', type=int, default=200)
+    parser.add_argument('--min-rows', type=int, default=MIN_ROWS)
+    parser.add_argument('--update', action='store_true', help=f'accept the current plans into {BASELINE.name}')
+    parser.add_argument('--check-indexes', action='store_true', help='confirm that every index in INDEXES is of use')
+    parser.add_argument('--seed', type=int, default=43)
+    args = parser.parse_args()
+
+    try:
+        if args.populate:
+            populate(args.populate, args.renters, args.seed)
+
+        instrumentation.capture_samples()
+        drive(args.seed)
+        captured = instrumentation.samples()
+        instrumentation.capture_samples(False)
+
+        (flagged, unexplained) = explain_all(captured, args.min_rows)
+
+        print(f'{len(captured)} query shapes captured, {len(flagged)} flagged, {len(unexplained)} not explained.')
+        for (fingerprint, entry) in flagged.items():
+            print(f"{entry['caller']}: {', '.join(entry['findings'])}\n    {fingerprint[:240]}")
+        for line in unexplained:
+            print(f'Not explained: {line}')
+
+        useless = check_indexes(captured, flagged, args.min_rows) if args.check_indexes else []
+    finally:
+        release()
+
+    if useless:
+        sys.exit(f"Indexes of no use to these queries: {', '.join(useless)}")
+
+    if args.update:
+        BASELINE.write_text(json.dumps(flagged, indent=2, sort_keys=True) + '\n')
+        print(f'Accepted these plans into {BASELINE}.')
+        return
+
+    accepted = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    regressions = [
+        f"{entry['caller']}: {finding}"
+        for (fingerprint, entry) in flagged.items()
+        for finding in entry['findings']
+        if finding not in accepted.get(fingerprint, {}).get('findings', [])
+    ]
+    if regressions:
+        sys.exit('Query plans regressed:\n' + '\n'.join(regressions) + f'\nFix them, or review and accept them into {BASELINE.name} with --update.')
+    print('No query plan regressions.')
+
+if __name__ == '__main__':
+    main()
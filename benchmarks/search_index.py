@@ -0,0 +1,181 @@
+# Runs random /listings searches through tables.listings.search and through
+# the in-process search_index, checks that both find the same nights (and the
+# same listings when grouped) and compares their timings. With --populate, first adds a synthetic host with
+# that many open nights (spread over listings of --nights each) to the
+# database, so only point it at a scratch database.
+#
+#   poetry install --extras search-index
+#   poetry run python -m benchmarks.search_index [--populate 1000000] [--searches N]
+
+import argparse
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+from mybnb import search_index, amenities, listing_calendars
+from mybnb.consts import AMENITIES_CHOICES, TYPE_CHOICES
+from mybnb.db import query, transaction, release
+from mybnb.tables import booking_slots, listings
+
+# Listings are scattered around Toronto
+CENTRE = (43.7, -79.4)
+
+def populate(nights: int, nights_per_listing: int, seed: int = 43):
+    generator = random.Random(seed)
+    suffix = generator.randrange(10 ** 6)
+
+    with transaction():
+        host_id = query(
+            '''
+                INSERT INTO Users(sin, username, name, dob)
+                VALUES (%(sin)s, %(username)s, 'Benchmark Host', '1970-01-01')
+            ''',
+            sin=900000000 + suffix,
+            username=f'benchmark-host-{suffix}'
+        ).lastrowid
+        query('INSERT INTO Hosts(user_id) VALUES (%(host_id)s)', host_id=host_id)
+
+        listing_count = -(-nights // nights_per_listing)
+        for start in range(0, listing_count, 1000):
+            batch = [
+                {
+                    'postal': f'M{generator.randint(1, 9)}{generator.choice("ABCDEFGHJKLMNPRSTVX")}'
+                              f'{generator.randint(1, 9)}A{generator.randint(1, 9)}',
+                    'address': f'{start + idx} Benchmark St',
+                    'lat': CENTRE[0] + generator.uniform(-0.3, 0.3),
+                    'lon': CENTRE[1] + generator.uniform(-0.4, 0.4),
+                    'type': generator.choice(TYPE_CHOICES),
+                    'amenities': generator.sample(AMENITIES_CHOICES, generator.randint(0, 8)),
+                }
+                for idx in range(min(1000, listing_count - start))
+            ]
+            query(
+                f'''
+                    INSERT INTO Listings(owner_id, country, city, postal, address, lat, lon, type, amenities, amenity_bits)
+                    VALUES {', '.join(
+                        f"""(%(host_id)s, 'Canada', 'Toronto', %(postal_{idx})s, %(address_{idx})s, %(lat_{idx})s, %(lon_{idx})s,
+                            %(type_{idx})s, %(amenities_{idx})s, %(amenity_bits_{idx})s)"""
+                        for idx in range(len(batch))
+                    )}
+                ''',
+                host_id=host_id,
+                **{
+                    f'{name}_{idx}': value
+                    for (idx, listing) in enumerate(batch)
+                    for (name, value) in [
+                        *((name, listing[name]) for name in ('postal', 'address', 'lat', 'lon', 'type')),
+                        ('amenities', ', '.join(listing['amenities'])),
+                        ('amenity_bits', amenities.bitmask(listing['amenities'])),
+                    ]
+                }
+            )
+
+        listing_ids = [row.id for row in query('SELECT id FROM Listings WHERE owner_id = %(host_id)s', host_id=host_id)]
+        booking_slots.add_ranges(
+            (listing_id, date.today(), date.today() + timedelta(days=nights_per_listing - 1))
+            for listing_id in listing_ids
+        )
+        query(
+            '''
+                INSERT INTO Availability(slot_id, rental_price)
+                SELECT S.id, ROUND(50 + RAND(%(seed)s) * 450)
+                FROM BookingSlots S
+                JOIN Listings L ON L.id = S.listing_id
+                WHERE L.owner_id = %(host_id)s
+            ''',
+            seed=seed,
+            host_id=host_id
+        )
+        listing_calendars.refresh_listing_ids(listing_ids)
+
+    print(f'Added {len(listing_ids)} listings with {len(listing_ids) * nights_per_listing} open nights for host {host_id}.')
+    return (host_id, listing_ids)
+
+def random_filters(generator: random.Random):
+    # Shaped like the filters app.listings builds from the search form
+    filters = []
+    if generator.random() < 0.5:
+        filters.append(('rental_price', generator.choice([100, 200, 300]), '<='))
+    if generator.random() < 0.3:
+        filters.append(('rental_price', generator.choice([60, 150]), '>='))
+    if generator.random() < 0.3:
+        filters.append(('sort', generator.choice(['Low To High', 'High To Low']), 'sort'))
+    if generator.random() < 0.2:
+        filters.append(('postal', f'M{generator.randint(1, 9)}{generator.choice("ABCDE")}', '='))
+    if generator.random() < 0.3:
+        filters.append(('type', generator.choice(TYPE_CHOICES), '='))
+    if generator.random() < 0.3:
+        filters.append(('amenities', generator.sample(AMENITIES_CHOICES, generator.randint(1, 2)), '&'))
+    if generator.random() < 0.5:
+        start = date.today() + timedelta(days=generator.randint(0, 20))
+        filters.append(('date', start.isoformat(), '>='))
+        end = start + timedelta(days=generator.randint(0, 14))
+        filters.append(('date', end.isoformat(), '<='))
+        if generator.random() < 0.3:
+            filters.append(('stay', (start.isoformat(), end.isoformat()), '='))
+    if generator.random() < 0.5:
+        point = (CENTRE[0] + generator.uniform(-0.2, 0.2), CENTRE[1] + generator.uniform(-0.3, 0.3))
+        filters.append(('distance', (*point, generator.choice([1, 5, 10])), '<='))
+        if generator.random() < 0.3:
+            filters.append(('nearest', generator.choice([5, 20]), '<='))
+    return filters
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--populate', type=int, default=0, metavar='NIGHTS')
+    parser.add_argument('--nights', type=int, default=60, help='open nights per populated listing')
+    parser.add_argument('--searches', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=43)
+    args = parser.parse_args()
+
+    try:
+        if args.populate:
+            populate(args.populate, args.nights, args.seed)
+
+        started = time.perf_counter()
+        snapshot = search_index.current()
+        print(f'Index of {len(snapshot.columns["listing_id"])} open nights loaded in {time.perf_counter() - started:.2f}s')
+
+        generator = random.Random(args.seed)
+        sql_timings, index_timings = [], []
+        for _ in range(args.searches):
+            filters = random_filters(generator)
+
+            # The first two pages of each
+            (sql_after, index_after) = (None, None)
+            for _ in range(2):
+                started = time.perf_counter()
+                (from_sql, sql_after) = listings.search(0, filters, after=sql_after)
+                sql_timings.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                (from_index, index_after) = search_index.search(0, filters, after=index_after)
+                index_timings.append(time.perf_counter() - started)
+
+                assert [row.availability_id for row in from_sql] == [row.availability_id for row in from_index], \
+                    f'results differ for {filters}'
+                if not sql_after:
+                    break
+
+            # And the first page of the one-result-per-listing search
+            started = time.perf_counter()
+            (from_sql, _) = listings.search_grouped(0, filters)
+            sql_timings.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            (from_index, _) = search_index.search_grouped(0, filters)
+            index_timings.append(time.perf_counter() - started)
+
+            assert [(row.listing_id, row.nights, bool(row.every_night)) for row in from_sql] \
+                == [(row.listing_id, row.nights, row.every_night) for row in from_index], \
+                f'grouped results differ for {filters}'
+
+        for (name, timings) in [('SQL', sql_timings), ('index', index_timings)]:
+            print(f'{name:>5}: median {statistics.median(timings) * 1000:.1f}ms, max {max(timings) * 1000:.1f}ms over {len(timings)} pages')
+        print(f'{statistics.median(sql_timings) / statistics.median(index_timings):.1f}x median speedup')
+    finally:
+        release()
+
+if __name__ == '__main__':
+    main()
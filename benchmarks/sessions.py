@@ -0,0 +1,94 @@
+# Measures the per-request overhead of each session store in mybnb.sessions
+# against a baseline app without sessions, for requests that only read the
+# session and for requests that change it. The database store needs the
+# Sessions table; it is skipped if the database can't be reached.
+#
+#   poetry run python -m benchmarks.sessions [--requests N] [--stores filesystem,cookie,database]
+
+import argparse
+import os
+import secrets
+import statistics
+import tempfile
+import time
+
+from flask import Flask, session
+from mysql.connector.errors import Error as MySQLError
+
+from mybnb import db, sessions
+
+def make_app(store):
+    app = Flask(__name__)
+    app.testing = True
+    if store is None:
+        # No secret key, no sessions
+        app.secret_key = None
+    else:
+        app.secret_key = os.environ['MYBNB_SECRET_KEY']
+        app.config['SESSION_FILE_DIR'] = tempfile.mkdtemp(prefix='mybnb-sessions-')
+        sessions.init_app(app, store)
+
+    @app.route('/log-in')
+    def log_in():
+        if not store:
+            return ''
+
+        # About what the app keeps for a logged-in user
+        session['user_id'] = 12345
+        session['user_roles'] = [True, False]
+        session['csrf_token'] = secrets.token_hex(20)
+        return ''
+
+    @app.route('/read')
+    def read():
+        return str(session.get('user_id')) if store else ''
+
+    @app.route('/write')
+    def write():
+        if store:
+            session['_flashes'] = [('success', 'Rating submitted.')]
+        return ''
+
+    return app
+
+def time_requests(client, path: str, count: int) -> list[float]:
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        client.get(path)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--stores', default=','.join(sessions.STORES))
+    args = parser.parse_args()
+
+    os.environ.setdefault('MYBNB_SECRET_KEY', secrets.token_hex(32))
+
+    results = {}
+    try:
+        for store in [None, *args.stores.split(',')]:
+            client = make_app(store).test_client()
+            try:
+                client.get('/log-in')
+            except MySQLError as e:
+                print(f'{store}: skipped ({e.msg})')
+                continue
+
+            results[store] = {
+                path: statistics.median(time_requests(client, f'/{path}', args.requests))
+                for path in ('read', 'write')
+            }
+    finally:
+        db.release()
+
+    baseline = results.pop(None)
+    print(f'Median overhead per request over {args.requests} requests, against {baseline["read"] * 1e6:.0f}µs without sessions:')
+    for (store, medians) in results.items():
+        print(f'{store:>10}: read {(medians["read"] - baseline["read"]) * 1e6:7.0f}µs, '
+              f'write {(medians["write"] - baseline["write"]) * 1e6:7.0f}µs')
+
+if __name__ == '__main__':
+    main()
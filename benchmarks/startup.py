@@ -0,0 +1,42 @@
+# Times cold imports of mybnb.app in fresh interpreters, and fails if the
+# median exceeds --max-seconds or if importing the app pulled in NLTK.
+#
+#   poetry run python -m benchmarks.startup [--runs N] [--max-seconds S]
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+PROBE = '''
+import sys
+import mybnb.app
+sys.exit(3 if 'nltk' in sys.modules else 0)
+'''
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-seconds', type=float, default=None)
+    args = parser.parse_args()
+
+    timings = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', PROBE])
+        timings.append(time.perf_counter() - started)
+
+        if result.returncode == 3:
+            sys.exit('Importing mybnb.app imported nltk; it should only be loaded by the noun phrase reports.')
+        if result.returncode:
+            sys.exit(f'Importing mybnb.app failed with exit status {result.returncode}.')
+
+    median = statistics.median(timings)
+    print(f'mybnb.app cold import over {args.runs} runs: median {median:.3f}s, min {min(timings):.3f}s, max {max(timings):.3f}s')
+
+    if args.max_seconds is not None and median > args.max_seconds:
+        sys.exit(f'Median cold import {median:.3f}s exceeds {args.max_seconds:.3f}s.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import sys
+from typing import Iterable
+
+from .db import query, release
+from .consts import AMENITIES_CHOICES
+
+# Listings.amenity_bits has bit i set iff the listing has AMENITIES_CHOICES[i],
+# so that amenities can be matched exactly ('Dryer' is not 'Hair dryer') and
+# with integer operations rather than LIKE. New amenities must therefore only
+# ever be appended to AMENITIES_CHOICES. The comma-joined Listings.amenities
+# is kept for display.
+BITS = {amenity: 1 << idx for (idx, amenity) in enumerate(AMENITIES_CHOICES)}
+
+def split(amenities: str) -> list[str]:
+    return amenities.split(', ')
+
+def bitmask(amenities: Iterable[str]) -> int:
+    # Names that aren't amenity choices (such as the '' of a listing without
+    # amenities) have no bit
+    bits = 0
+    for amenity in amenities:
+        bits |= BITS.get(amenity, 0)
+    return bits
+
+def names(bits: int) -> list[str]:
+    return [amenity for (amenity, bit) in BITS.items() if bits & bit]
+
+def backfill():
+    # Derives amenity_bits from the amenities text of every listing, e.g.
+    # after populating the database
+    query(
+        f'''
+            UPDATE Listings
+            SET
+                amenity_bits = {' | '.join(
+                    f"(FIND_IN_SET(%(amenity_{idx})s, REPLACE(amenities, ', ', ',')) > 0) << {idx}"
+                    for idx in range(len(AMENITIES_CHOICES))
+                )}
+        ''',
+        **{
+            f'amenity_{idx}': amenity
+            for (idx, amenity) in enumerate(AMENITIES_CHOICES)
+        }
+    )
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['backfill']:
+        sys.exit(f'usage: python -m {__spec__.name} backfill')
+
+    try:
+        backfill()
+    finally:
+        release()
@@ -1,23 +1,31 @@
-from flask import Flask, render_template, redirect, url_for, request, session, flash
+from flask import Flask, render_template, redirect, url_for, request, session, flash, abort
 from flask_bootstrap import Bootstrap5
-from flask_session import Session
 from flask_wtf import FlaskForm
-from mysql.connector import IntegrityError, DataError
-from wtforms import StringField, PasswordField, IntegerField, FloatField, SelectField, SelectMultipleField, SubmitField
+from mysql.connector import IntegrityError, DataError, DatabaseError
+from wtforms import StringField, PasswordField, IntegerField, FloatField, SelectField, SelectMultipleField, SubmitField, BooleanField
 from wtforms.validators import DataRequired, Optional, Length, Regexp, NumberRange, ValidationError
 from datetime import date, datetime, timedelta
+import math
+import os
 
-from . import tables, sanitize, reports, host_toolkit
+from . import tables, sanitize, background_reports, comment_nouns, host_toolkit, db, instrumentation, search_index, listing_calendars, sessions
 from .consts import AMENITIES_CHOICES, TYPE_CHOICES
 
 app = Flask(__name__)
-app.secret_key = 'B5F61F92-EADD-4952-A165-A39568B83603'
+app.secret_key = os.environ.get('MYBNB_SECRET_KEY', 'B5F61F92-EADD-4952-A165-A39568B83603')
 
-app.config['SESSION_TYPE'] = 'filesystem'
-Session(app)
+sessions.init_app(app)
 
 Bootstrap5(app)
 
+db.init_app(app)
+instrumentation.init_app(app)
+
+# NLTK is otherwise loaded by the first noun phrase report; workers that
+# mainly serve reports can pay for it at boot instead
+if os.environ.get('MYBNB_PRELOAD_NLTK'):
+    comment_nouns.preload()
+
 
 def form_endpoint(form, template_path: str, on_submit: callable, next_location: str = None, template_args: dict = {}):
     if not isinstance(form, FlaskForm):
@@ -37,6 +45,14 @@ def form_endpoint(form, template_path: str, on_submit: callable, next_location:
 
     return render_template(template_path, form=form, **template_args)
 
+def validate_date(field):
+    if not field.data:
+        return
+    try:
+        sanitize.date(field.data)
+    except ValueError:
+        raise ValidationError("Invalid date format. Please use YYYY-MM-DD.")
+
 def validate_dob(field):
     if not field.data:
         return
@@ -289,6 +305,67 @@ def listing_create():
         }
     )
 
+@app.route('/my-listings/pricing', methods=['GET', 'POST'])
+def listings_pricing():
+    class Form(FlaskForm):
+        listing_ids = SelectMultipleField(
+            'Listings (select multiple)',
+            coerce=int,
+            validators=[DataRequired()],
+            render_kw={
+                'size': '10'
+            }
+        )
+
+        start_date = StringField('Start Date', validators=[Length(1, 15)], render_kw={"placeholder": "YYYY-MM-DD"})
+        end_date = StringField('End Date', validators=[Length(1, 15)], render_kw={"placeholder": "YYYY-MM-DD"})
+
+        weekday_price = FloatField('Price for Sunday to Thursday Nights', validators=[Optional(), NumberRange(min=0)])
+        weekend_price = FloatField('Price for Friday and Saturday Nights', validators=[Optional(), NumberRange(min=0)])
+        percent_change = FloatField('Or Change Prices of Open Nights by (%)', validators=[Optional(), NumberRange(min=-100)], render_kw={"placeholder": "-10"})
+
+        submit = SubmitField('Apply Prices', render_kw={'class': 'btn-success'})
+
+        def validate_start_date(form, field):
+            validate_date(field)
+
+        def validate_end_date(form, field):
+            validate_date(field)
+            if field.data and not form.start_date.errors and sanitize.date(field.data) < sanitize.date(form.start_date.data):
+                raise ValidationError("End Date cannot be before Start Date.")
+
+    form = Form()
+    form.listing_ids.choices = [
+        (listing.id, f'{listing.type} in {listing.city} at {listing.postal}')
+        for listing in tables.listings.owned_by_current_user()
+    ]
+
+    def on_submit(form):
+        has_prices = form.weekday_price.data is not None or form.weekend_price.data is not None
+        if has_prices == (form.percent_change.data is not None):
+            raise ValidationError('Enter nightly prices or a percentage change, but not both.')
+
+        repriced = tables.booking_slots.set_prices(
+            form.listing_ids.data,
+            sanitize.date(form.start_date.data),
+            sanitize.date(form.end_date.data),
+            tables.booking_slots.PricingRule(
+                weekday_price=form.weekday_price.data,
+                weekend_price=form.weekend_price.data,
+                percent_change=form.percent_change.data
+            )
+        )
+        flash(f'Prices set for {repriced} nights.', 'success')
+
+    return form_endpoint(
+        form, 'listings-pricing.html',
+        on_submit=on_submit,
+        next_location='/my-listings',
+        template_args={
+            'user': tables.users.current()
+        }
+    )
+
 @app.route('/my-listings/<id>/edit', methods=['GET', 'POST'])
 def listing_edit(id):
     def on_submit(form):
@@ -341,13 +418,23 @@ def listing_schedule(id):
     today = datetime.now().date()
     two_weeks_ago = today - timedelta(days=15)
 
+    # Open nights of the coming weeks at a glance, Monday to Sunday
+    week_start = today - timedelta(days=today.weekday())
+    calendar_weeks = [
+        [week_start + timedelta(days=7 * week + day) for day in range(7)]
+        for week in range(8)
+    ]
+
     return render_template(
         'listing-schedule.html',
         user=tables.users.current(),
         listing=listing,
         slots=tables.booking_slots.all_for_listing(listing),
         pastslots=tables.booking_slots.past_slots_for_listing(listing),
-        two_weeks_ago=two_weeks_ago
+        two_weeks_ago=two_weeks_ago,
+        today=today,
+        calendar_weeks=calendar_weeks,
+        open_dates=listing_calendars.open_dates(listing.id)
     )
 
 @app.route('/my-listings/<listing_id>/schedule/<renter_id>/rate-renter', methods=['GET', 'POST'])
@@ -358,6 +445,8 @@ def rate_renter(listing_id, renter_id):
 
         submit = SubmitField('Submit Comments and Rating', render_kw={'class': 'btn-primary'})
 
+    # Fetched together with the current user
+    tables.users.want([renter_id])
     current_user = tables.users.current()
 
     def on_submit(form):
@@ -398,6 +487,53 @@ def listing_schedule_cancel(listing_id, slot_id):
     flash(f'Booking on {tables.booking_slots.for_id(slot_id).date} cancelled.', 'success')
     return redirect(f'/my-listings/{listing_id}/schedule')
 
+def bulk_schedule_selection(listing_id):
+    # Days ticked on the schedule page, or else the date range entered there
+    slot_ids = request.form.getlist('slot_ids', type=int)
+    if slot_ids:
+        return {'listing_ids': [listing_id], 'slot_ids': slot_ids}
+
+    start_date = request.form.get('start_date')
+    end_date = request.form.get('end_date')
+    if not (start_date and end_date):
+        raise ValidationError('Select some days or enter a date range.')
+
+    try:
+        (start_date, end_date) = (sanitize.date(start_date), sanitize.date(end_date))
+    except ValueError:
+        raise ValidationError('Invalid date format. Please use YYYY-MM-DD.')
+    if end_date < start_date:
+        raise ValidationError('The end date cannot be before the start date.')
+
+    return {'listing_ids': [listing_id], 'start_date': start_date, 'end_date': end_date}
+
+@app.route('/my-listings/<listing_id>/schedule/bulk/retract', methods=['POST'])
+def listing_schedule_bulk_retract(listing_id):
+    try:
+        retracted = tables.booking_slots.retract_many(**bulk_schedule_selection(listing_id))
+        flash(f'Availability retracted for {retracted} days.', 'success')
+    except ValidationError as e:
+        flash(str(e), 'danger')
+    return redirect(f'/my-listings/{listing_id}/schedule')
+
+@app.route('/my-listings/<listing_id>/schedule/bulk/delete', methods=['POST'])
+def listing_schedule_bulk_delete(listing_id):
+    try:
+        deleted = tables.booking_slots.delete_many(**bulk_schedule_selection(listing_id))
+        flash(f'{deleted} booking slots were deleted.', 'success')
+    except ValidationError as e:
+        flash(str(e), 'danger')
+    return redirect(f'/my-listings/{listing_id}/schedule')
+
+@app.route('/my-listings/<listing_id>/schedule/bulk/cancel', methods=['POST'])
+def listing_schedule_bulk_cancel(listing_id):
+    try:
+        cancelled = tables.bookings.cancel_many(**bulk_schedule_selection(listing_id))
+        flash(f'{cancelled} bookings cancelled.', 'success')
+    except ValidationError as e:
+        flash(str(e), 'danger')
+    return redirect(f'/my-listings/{listing_id}/schedule')
+
 @app.route('/my-listings/<listing_id>/schedule/<slot_id>/set-price', methods=['GET', 'POST'])
 def listing_schedule_slot_set_price(listing_id, slot_id):
     class Form(FlaskForm):
@@ -446,11 +582,17 @@ def listing_schedule_slot_set_price(listing_id, slot_id):
 @app.route('/my-listings/<listing_id>/schedule/<slot_id>/info')
 def listing_schedule_slot_info(listing_id, slot_id):
     slot = tables.booking_slots.for_id(slot_id)
+    if not slot:
+        abort(404)
     cancellations = tables.bookings.cancellations(slot_id)
 
+    # The renter is fetched together with the current user
+    tables.users.want([slot.renter_id])
+    user = tables.users.current()
+
     return render_template(
         'listing-schedule-slot-info.html',
-        user=tables.users.current(),
+        user=user,
         listing=slot.listing,
         slot=slot,
         renter=(slot.renter_id and tables.users.for_id(slot.renter_id)),
@@ -458,13 +600,9 @@ def listing_schedule_slot_info(listing_id, slot_id):
     )
 
 def add_booking_slots(listing_id, start_date: date, end_date: date):
-    for day_offset in range(0, (end_date - start_date).days + 1):
-        tables.booking_slots.add(
-            listing_id=listing_id,
-            date=start_date + timedelta(days=day_offset)
-        )
+    added = tables.booking_slots.add_range(listing_id, start_date, end_date)
 
-    flash(f'{start_date} thru {end_date} added to schedule.', 'success')
+    flash(f'{start_date} thru {end_date} added to schedule ({added} new days).', 'success')
 
 @app.route('/my-listings/<listing_id>/schedule/add-week-of-slots', methods=['POST'])
 def listing_schedule_add_week_of_slots(listing_id):
@@ -486,6 +624,18 @@ def listing_schedule_add_slots(listing_id):
 
         submit = SubmitField('Add Days to Schedule', render_kw={'class': 'btn-primary'})
 
+        def validate_start_date(form, field):
+            validate_date(field)
+
+        def validate_end_date(form, field):
+            validate_date(field)
+            if field.data and not form.start_date.errors:
+                days = (sanitize.date(field.data) - sanitize.date(form.start_date.data)).days
+                if days < 0:
+                    raise ValidationError("End Date cannot be before Start Date.")
+                if days >= tables.booking_slots.MAX_RANGE_DAYS:
+                    raise ValidationError(f"At most {tables.booking_slots.MAX_RANGE_DAYS} days can be added at once.")
+
     def on_submit(form):
         add_booking_slots(listing_id, sanitize.date(form.start_date.data), sanitize.date(form.end_date.data))
     
@@ -555,6 +705,8 @@ def rate_host(host_id):
 
         submit = SubmitField('Submit Comments and Rating', render_kw={'class': 'btn-primary'})
 
+    # Fetched together with the current user
+    tables.users.want([host_id])
     current_user = tables.users.current()
 
     def on_submit(form):
@@ -582,6 +734,7 @@ def listings():
         latitude = FloatField('Latitude', validators=[Optional()], render_kw={"placeholder": "43.784093"})
         longitude = FloatField('Longitude', validators=[Optional()], render_kw={"placeholder": "-79.186527"})
         max_distance = FloatField('Max Distance (km; default: 5km)', validators=[Optional()], render_kw={"placeholder": "5"})
+        nearest = IntegerField('Nearest Listings Only (Count)', validators=[Optional(), NumberRange(min=1)], render_kw={"placeholder": "10"})
 
         max_price = FloatField('Max Price', validators=[Optional()], render_kw={"placeholder": "1000"})
         min_price = FloatField('Min Price', validators=[Optional()], render_kw={"placeholder": "100"})
@@ -592,6 +745,7 @@ def listings():
 
         start_date = StringField('Booking Period Start', validators=[Optional()], render_kw={"placeholder": "YYYY-MM-DD"})
         end_date = StringField('Booking Period End', validators=[Optional()], render_kw={"placeholder": "YYYY-MM-DD"})
+        every_night = BooleanField('Open Every Night of the Booking Period Only')
 
         type = SelectField('Type', choices=[None, *TYPE_CHOICES])
         amenities = SelectMultipleField(
@@ -602,15 +756,27 @@ def listings():
             }
         )
 
+        group_by_listing = BooleanField('One Result per Listing (Summing Up Its Nights)')
+
         submit = SubmitField('Apply Filters')
 
+        def validate_start_date(form, field):
+            validate_date(field)
+
+        def validate_end_date(form, field):
+            validate_date(field)
+            if field.data and form.start_date.data and not form.start_date.errors:
+                if sanitize.date(field.data) < sanitize.date(form.start_date.data):
+                    raise ValidationError("Booking Period End cannot be before its start.")
+
 
     def on_submit(form):
         pass
     listings = []
+    next_after = None
 
     form = Form()
-    if form.is_submitted():
+    if form.validate_on_submit():
         filters = []
 
         if form.max_price.data:
@@ -626,19 +792,29 @@ def listings():
         if form.type.data:
             filters.append(('type',form.type.data,'='))
         if form.amenities.data:
-            filters.append(('amenities',form.amenities.data,'LIKE'))
+            filters.append(('amenities',form.amenities.data,'&'))
         if form.start_date.data:
-            filters.append(('date',form.start_date.data,'>='))   
+            filters.append(('date',sanitize.date(form.start_date.data).isoformat(),'>='))
         if form.end_date.data:
-            filters.append(('date',form.end_date.data,'<='))
+            filters.append(('date',sanitize.date(form.end_date.data).isoformat(),'<='))
+        if form.every_night.data and form.start_date.data and form.end_date.data:
+            filters.append(('stay',(sanitize.date(form.start_date.data).isoformat(),sanitize.date(form.end_date.data).isoformat()),'='))
         
         if form.latitude.data and form.longitude.data:
             if not form.max_distance.data:
                 form.max_distance.data = 5
             filters.append(('distance',(form.latitude.data,form.longitude.data,form.max_distance.data),'<='))
+            if form.nearest.data:
+                filters.append(('nearest',form.nearest.data,'<='))
 
         id = tables.users.current().id
-        listings = tables.listings.search(id,filters)
+        if form.group_by_listing.data:
+            search = (search_index.search_grouped if search_index.ENABLED else tables.listings.search_grouped)
+        else:
+            search = (search_index.search if search_index.ENABLED else tables.listings.search)
+
+        # Set by the next page button, to the cursor of the page after this one
+        (listings, next_after) = search(id, filters, after=request.form.get('after'))
         
 
     return form_endpoint(
@@ -646,108 +822,131 @@ def listings():
         on_submit=on_submit,
         template_args={
             'user': tables.users.current(),
-            'listings': listings
+            'listings': listings,
+            'grouped': form.group_by_listing.data,
+            'next_after': next_after
         }
     )
 
+BOOKING_CONTENTION_MESSAGE = 'Those nights are being booked by someone else right now. Please try again.'
+
 @app.route('/listings/<id>/book', methods=['GET','POST'])
 def book_listing(id):
-    tables.bookings.book(id)
-    flash('Rental was booked.', 'success')
+    try:
+        tables.bookings.book(id)
+    except ValidationError as e:
+        flash(str(e), 'danger')
+    except DatabaseError as e:
+        if e.errno not in tables.bookings.CONTENTION_ERRORS:
+            raise
+        flash(BOOKING_CONTENTION_MESSAGE, 'danger')
+    else:
+        flash('Rental was booked.', 'success')
+    return redirect('/listings')
+
+@app.route('/listings/<listing_id>/book-stay', methods=['POST'])
+def book_listing_stay(listing_id):
+    try:
+        nights = tables.bookings.book_stay(
+            listing_id,
+            sanitize.date(request.form['start_date']),
+            sanitize.date(request.form['end_date'])
+        )
+    except ValueError:
+        flash('Invalid date format. Please use YYYY-MM-DD.', 'danger')
+    except ValidationError as e:
+        flash(str(e), 'danger')
+    except DatabaseError as e:
+        if e.errno not in tables.bookings.CONTENTION_ERRORS:
+            raise
+        flash(BOOKING_CONTENTION_MESSAGE, 'danger')
+    else:
+        flash(f'Stay of {nights} night{"s" if nights != 1 else ""} was booked.', 'success')
     return redirect('/listings')
 
+class ReportForm(FlaskForm):
+    start_date = StringField('Start Date', validators=[Length(1, 15)], render_kw={"placeholder": "YYYY-MM-DD"})
+    end_date = StringField('End Date', validators=[Length(1, 15)], render_kw={"placeholder": "YYYY-MM-DD"})
+
+    submit = SubmitField('Generate Report')
+
+    def validate_start_date(form, field):
+        validate_date(field)
+
+    def validate_end_date(form, field):
+        validate_date(field)
+        if field.data and not form.start_date.errors and sanitize.date(field.data) < sanitize.date(form.start_date.data):
+            raise ValidationError("End Date cannot be before Start Date.")
+
 @app.route('/reports', methods=['GET', 'POST'])
 def reports_():
-    class Form(FlaskForm):
-        start_date = StringField('Start Date', validators=[Length(1, 15)], render_kw={"placeholder": "YYYY-MM-DD"})
-        end_date = StringField('End Date', validators=[Length(1, 15)], render_kw={"placeholder": "YYYY-MM-DD"})
+    # Reports are generated in the background; the submitter is sent to a
+    # page that polls until every section is done
+    form = ReportForm()
+    if form.validate_on_submit():
+        # As dates, so that 2024-1-5 and 2024-01-05 share a report
+        report_id = background_reports.submit(sanitize.date(form.start_date.data), sanitize.date(form.end_date.data))
+        return redirect(f'/reports/{report_id}')
 
-        submit = SubmitField('Generate Report')
+    return render_template(
+        'reports.html',
+        form=form,
+        user=tables.users.current(),
+        background_report=None,
+        report=[]
+    )
 
-    def on_submit(form):
-        pass
+@app.route('/reports/<report_id>')
+def report_progress(report_id):
+    background_report = background_reports.get(report_id)
+    if not background_report:
+        # Kept reports are pruned as new ones come in
+        flash('That report is no longer available; please generate it again.', 'danger')
+        return redirect('/reports')
 
-    report = []
+    form = ReportForm()
+    form.start_date.data = background_report.start_date
+    form.end_date.data = background_report.end_date
 
-    form = Form()
-    if form.is_submitted():
-        start_date = form.start_date.data
-        end_date = form.end_date.data
-
-        report.append({
-            'title': 'Bookings by City',
-            'records': reports.count_bookings_by_city(start_date, end_date)
-        })
-        report.append({
-            'title': 'Bookings by City and Postal Code',
-            'records': reports.count_bookings_by_city_postal(start_date, end_date)
-        })
-
-        report.append({
-            'title': 'Listings by Country',
-            'records': reports.count_listings_by_country()
-        })
-        report.append({
-            'title': 'Listings by Country and City',
-            'records': reports.count_listings_by_country_city()
-        })
-        report.append({
-            'title': 'Listings by Country, City, and Postal Code',
-            'records': reports.count_listings_by_country_city_postal()
-        })
-
-        for country, in reports.all_countries():
-            report.append({
-                'title': f'Top Hosts in {country}',
-                'records': reports.top_hosts_in_country(country)
-            })
-        for country, city in reports.all_country_cities():
-            report.append({
-                'title': f'Top Hosts in {city}, {country}',
-                'records': reports.top_hosts_in_country_city(country, city)
-            })
-
-        for country, city in reports.all_country_cities():
-            report.append({
-                'title': f'Potential Commercial Hosts in {city}, {country}',
-                'records': reports.potential_commercial_hosts(country, city)
-            })
-
-        report.append({
-            'title': 'Top Renters by Bookings',
-            'records': reports.top_renters(start_date, end_date)
-        })
-        for country, city in reports.all_country_cities():
-            report.append({
-                'title': f'Top Renters in {city}, {country} by Bookings (≥2)',
-                'records': reports.top_renters_by_country_city(start_date, end_date, country, city)
-            })
-
-        report.append({
-            'title': 'Top Hosts by Cancellations',
-            'records': reports.top_cancelling_hosts(start_date, end_date)
-        })
-        report.append({
-            'title': 'Top Renters by Cancellations',
-            'records': reports.top_cancelling_renters(start_date, end_date)
-        })
-
-        report.append({
-            'title': 'Top Noun Phrases by Listing Comment',
-            'records': reports.top_noun_phrases_by_listing_comment()
-        })
-        report.append({
-            'title': 'Top Noun Phrases in All Listing Comments',
-            'records': reports.top_noun_phrases_in_listing_comments()
-        })
+    return render_template(
+        'reports.html',
+        form=form,
+        user=tables.users.current(),
+        background_report=background_report,
+        report=(background_report.report or [])
+    )
 
-    return form_endpoint(
-        Form, 'reports.html',
-        on_submit=on_submit,
-        template_args={
-            'user': tables.users.current(),
-            'report': report
-        }
+@app.route('/_debug/queries', methods=['GET', 'POST'])
+def debug_queries():
+    if not (app.debug or os.environ.get('MYBNB_DEBUG_QUERIES')):
+        abort(404)
+
+    # Changes to the instrumentation only come from the page's buttons
+    if request.method == 'POST':
+        if 'log_sample_rate' in request.form:
+            try:
+                rate = float(request.form['log_sample_rate'])
+            except ValueError:
+                rate = None
+            # float() also takes 'nan' and 'inf'
+            if rate is not None and math.isfinite(rate) and 0 <= rate <= 1:
+                instrumentation.set_log_sample_rate(rate)
+            else:
+                flash('The sample rate must be a number from 0 to 1.', 'danger')
+        if 'reset' in request.form:
+            instrumentation.reset()
+        return redirect(url_for('debug_queries', **request.args))
+
+    try:
+        limit = max(int(request.args.get('limit', 25)), 1)
+    except ValueError:
+        limit = 25
+
+    return render_template(
+        'debug-queries.html',
+        fingerprints=instrumentation.top_fingerprints(limit),
+        log_sample_rate=instrumentation.log_sample_rate,
+        pool_stats=db.pool.stats()
     )
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from . import db, reports, report_runner
+
+MAX_CONCURRENT_REPORTS = int(os.environ.get('MYBNB_MAX_CONCURRENT_REPORTS', 2))
+
+# Finished and in-progress reports kept around for polling and reuse
+MAX_KEPT_REPORTS = int(os.environ.get('MYBNB_MAX_KEPT_REPORTS', 32))
+
+# Seconds without progress after which an unfinished report is taken to have
+# lost its worker (restarted, or killed) rather than to be still running or
+# queued behind others
+ABANDONED_AFTER = 2 * report_runner.REPORT_TIMEOUT
+
+ABANDONED_MESSAGE = 'The worker generating this report went away; please submit it again.'
+
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REPORTS, thread_name_prefix='mybnb-background-report')
+
+# Reports are kept in the BackgroundReports table, so that any worker can
+# answer the polls for them and reuse them; only the worker that submitted
+# one runs it
+class BackgroundReport:
+    def __init__(self, row):
+        self.id = row.id
+        self.start_date = row.start_date
+        self.end_date = row.end_date
+        self.data_version = row.data_version
+
+        self.sections = json.loads(row.sections)
+        self.report: Optional[list[dict]] = _load_report(row.report) if row.report is not None else None
+        self.error: Optional[str] = row.error
+        if not self.done and row.abandoned:
+            self.error = ABANDONED_MESSAGE
+
+    @property
+    def done(self) -> bool:
+        return self.report is not None or self.error is not None
+
+    @property
+    def sections_done(self) -> int:
+        return sum(section['done'] for section in self.sections)
+
+_COLUMNS = f'''
+    id, start_date, end_date, data_version, sections, report, error,
+    updated_at < UTC_TIMESTAMP(6) - INTERVAL {ABANDONED_AFTER:g} SECOND AS abandoned
+'''
+
+def get(id) -> Optional[BackgroundReport]:
+    row = db.query(f'SELECT {_COLUMNS} FROM BackgroundReports WHERE id = %(id)s', id=id).fetchone()
+    return BackgroundReport(row) if row else None
+
+def submit(start_date, end_date) -> str:
+    # Reports for the same range are shared until something is written,
+    # whether they are still running or already finished; returns the id
+    data_version = db.data_version()
+    for row in db.query(
+        f'''
+            SELECT {_COLUMNS}
+            FROM BackgroundReports
+            WHERE
+                start_date = %(start_date)s AND
+                end_date = %(end_date)s AND
+                data_version = %(data_version)s AND
+                error IS NULL
+            ORDER BY submitted_at DESC
+        ''',
+        start_date=start_date,
+        end_date=end_date,
+        data_version=data_version
+    ).fetchall():
+        if not BackgroundReport(row).error:
+            return row.id
+
+    jobs = reports.report_jobs(start_date, end_date)
+    sections = [
+        {'title': job.title, 'done': False, 'seconds': None}
+        for job in jobs
+    ]
+    id = uuid.uuid4().hex
+
+    # Bookkeeping, not data; polling and reuse must not see it as a write
+    db.untracked_query(
+        '''
+            INSERT INTO BackgroundReports(id, start_date, end_date, data_version, submitted_at, updated_at, sections)
+            VALUES (%(id)s, %(start_date)s, %(end_date)s, %(data_version)s, UTC_TIMESTAMP(6), UTC_TIMESTAMP(6), %(sections)s)
+        ''',
+        id=id,
+        start_date=start_date,
+        end_date=end_date,
+        data_version=data_version,
+        sections=json.dumps(sections)
+    )
+    db.untracked_query(
+        '''
+            DELETE FROM BackgroundReports
+            WHERE submitted_at < (
+                SELECT submitted_at FROM (
+                    SELECT submitted_at
+                    FROM BackgroundReports
+                    ORDER BY submitted_at DESC
+                    LIMIT 1 OFFSET %(kept)s
+                ) AS Oldest
+            )
+        ''',
+        kept=MAX_KEPT_REPORTS - 1
+    )
+
+    _executor.submit(_run, id, jobs, sections)
+    return id
+
+def _run(id, jobs, sections: list[dict]):
+    lock = threading.Lock()
+
+    def save_sections():
+        db.untracked_query(
+            '''
+                UPDATE BackgroundReports
+                SET
+                    sections = %(sections)s,
+                    updated_at = UTC_TIMESTAMP(6)
+                WHERE id = %(id)s
+            ''',
+            id=id,
+            sections=json.dumps(sections)
+        )
+
+    # Called from the report's worker threads, which must not keep the
+    # connection
+    def on_progress(idx, seconds):
+        with lock:
+            sections[idx].update(done=True, seconds=seconds)
+            try:
+                save_sections()
+            finally:
+                db.release()
+
+    try:
+        # Started after waiting its turn; the wait isn't lost progress
+        save_sections()
+        report = report_runner.run(jobs, on_progress=on_progress)
+        (saved_report, error) = (_dump_report(report), None)
+    except Exception as e:
+        (saved_report, error) = (None, str(e) or type(e).__name__)
+
+    try:
+        db.untracked_query(
+            '''
+                UPDATE BackgroundReports
+                SET
+                    report = %(report)s,
+                    error = %(error)s,
+                    updated_at = UTC_TIMESTAMP(6)
+                WHERE id = %(id)s
+            ''',
+            id=id,
+            report=saved_report,
+            error=(error[:1023] if error else None)
+        )
+    finally:
+        db.release()
+
+def _dump_report(report: list[dict]) -> str:
+    # Records are named tuples; kept as their field names and rows, with
+    # dates and decimals as the text they are shown as
+    return json.dumps([
+        {
+            'title': section['title'],
+            'seconds': section['seconds'],
+            'error': section.get('error'),
+            'fields': list(section['records'][0]._fields) if section['records'] else [],
+            'rows': [list(record) for record in section['records']]
+        }
+        for section in report
+    ], default=str)
+
+def _load_report(saved: str) -> list[dict]:
+    report = []
+    for section in json.loads(saved):
+        Record = namedtuple('Record', section['fields'])
+        report.append({
+            'title': section['title'],
+            'seconds': section['seconds'],
+            'error': section['error'],
+            'records': [Record(*row) for row in section['rows']]
+        })
+    return report
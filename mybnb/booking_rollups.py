@@ -0,0 +1,111 @@
+import sys
+
+from .db import query, transaction, release
+
+# BookingRollups counts Bookings rows per (date, listing, renter, cancelled),
+# so that the booking reports can aggregate over days in a date range rather
+# than joining every booking back to its slot. A (date, listing) pair is
+# exactly one BookingSlots row.
+
+def record_bookings(availability_ids_sql: str, renter_id, **env):
+    query(
+        f'''
+            INSERT INTO BookingRollups(date, listing_id, renter_id, cancelled, count)
+            SELECT S.date, S.listing_id, %(renter_id)s, 0, COUNT(*)
+            FROM Availability A
+            JOIN BookingSlots S ON S.id = A.slot_id
+            WHERE A.id IN ({availability_ids_sql})
+            GROUP BY S.date, S.listing_id
+            ON DUPLICATE KEY UPDATE
+                count = BookingRollups.count + VALUES(count)
+        ''',
+        renter_id=renter_id,
+        **env
+    )
+
+def record_booking(availability_id, renter_id):
+    record_bookings('%(availability_id)s', renter_id, availability_id=availability_id)
+
+def record_cancellations_on_slots(slot_ids_sql: str, **env):
+    # Must run before the slots' live bookings are marked cancelled
+    live_bookings_sql = f'''
+        SELECT S.date, S.listing_id, B.renter_id, COUNT(*) AS count
+        FROM BookingSlots S
+        JOIN Availability A ON A.slot_id = S.id
+        JOIN BookingsLive B ON B.availability_id = A.id
+        WHERE S.id IN ({slot_ids_sql})
+        GROUP BY S.date, S.listing_id, B.renter_id
+    '''
+
+    with transaction():
+        query(
+            f'''
+                INSERT INTO BookingRollups(date, listing_id, renter_id, cancelled, count)
+                SELECT date, listing_id, renter_id, 1, count
+                FROM ({live_bookings_sql}) D
+                ON DUPLICATE KEY UPDATE
+                    count = BookingRollups.count + VALUES(count)
+            ''',
+            **env
+        )
+        query(
+            f'''
+                UPDATE BookingRollups R
+                JOIN ({live_bookings_sql}) D ON D.date = R.date AND D.listing_id = R.listing_id AND D.renter_id = R.renter_id
+                SET
+                    R.count = R.count - D.count
+                WHERE NOT R.cancelled
+            ''',
+            **env
+        )
+        query(
+            f'''
+                DELETE R
+                FROM BookingRollups R
+                JOIN BookingSlots S ON S.date = R.date AND S.listing_id = R.listing_id
+                WHERE S.id IN ({slot_ids_sql}) AND R.count <= 0
+            ''',
+            **env
+        )
+
+def record_cancellations(slot_id):
+    record_cancellations_on_slots('%(slot_id)s', slot_id=slot_id)
+
+def forget_slots(slot_ids_sql: str, **env):
+    # Must run before the slots (and, by cascade, their bookings) are deleted
+    query(
+        f'''
+            DELETE R
+            FROM BookingRollups R
+            JOIN BookingSlots S ON S.date = R.date AND S.listing_id = R.listing_id
+            WHERE S.id IN ({slot_ids_sql})
+        ''',
+        **env
+    )
+
+def forget_slot(slot_id):
+    forget_slots('%(slot_id)s', slot_id=slot_id)
+
+def rebuild():
+    with transaction():
+        query('DELETE FROM BookingRollups')
+        query(
+            '''
+                INSERT INTO BookingRollups(date, listing_id, renter_id, cancelled, count)
+                SELECT S.date, S.listing_id, B.renter_id, B.cancelled, COUNT(*)
+                FROM Bookings B
+                JOIN Availability A ON A.id = B.availability_id
+                JOIN BookingSlots S ON S.id = A.slot_id
+                WHERE B.cancelled IS NOT NULL
+                GROUP BY S.date, S.listing_id, B.renter_id, B.cancelled
+            '''
+        )
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['rebuild']:
+        sys.exit(f'usage: python -m {__spec__.name} rebuild')
+
+    try:
+        rebuild()
+    finally:
+        release()
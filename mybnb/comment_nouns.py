@@ -0,0 +1,192 @@
+import hashlib
+import itertools
+import multiprocessing
+import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, NamedTuple
+
+from .db import query, transaction, untracked_query
+
+# Nouns are extracted once per listing comment and cached in
+# ListingCommentNouns under a hash of the comment text, so only new or edited
+# comments are tagged. ListingCommentNounCounts holds the number of times each
+# noun occurs across all cached comments and is adjusted by the same deltas.
+# The cache has no foreign key to ListingComments on purpose: rows whose
+# comment has gone away are found (and uncounted) by refresh(). Its writes
+# are untracked: they follow the comments rather than change any data, and
+# bumping the data version from inside a report would invalidate that very
+# report in background_reports.
+
+# Held while refreshing, so that concurrent report sections and workers don't
+# tag the same comments twice or apply the same count deltas twice
+LOCK_NAME = 'mybnb.comment_nouns'
+LOCK_TIMEOUT = 300
+
+# Tagging is CPU-bound pure Python, so large backlogs are spread over
+# processes; a single chunk is always tagged in-process
+WORKERS = int(os.environ.get('MYBNB_NLP_WORKERS', os.cpu_count() or 1))
+CHUNK_SIZE = int(os.environ.get('MYBNB_NLP_CHUNK_SIZE', 500))
+
+class TaggedChunk(NamedTuple):
+    # One list of nouns per text, in order
+    nouns: list[list[str]]
+    counts: Counter
+
+# NLTK takes a good while to import and its tagger model to load, and only
+# the noun phrase reports need it, so neither happens until first use
+
+def preload():
+    # Pays the import and model loading up front, e.g. in report workers
+    find_noun_phrases('Warm up the tagger.')
+
+def find_noun_phrases(text: str):
+    import nltk
+
+    tokens = nltk.word_tokenize(text)
+    return [word for (word, tag) in nltk.pos_tag(tokens) if tag.startswith('N')]
+
+def tag_chunk(texts: list[str]) -> TaggedChunk:
+    nouns = [find_noun_phrases(text) for text in texts]
+    return TaggedChunk(
+        nouns=nouns,
+        counts=Counter(noun for text_nouns in nouns for noun in text_nouns if noun)
+    )
+
+def tag_chunks(chunks: Iterable[list[str]], workers: int = WORKERS) -> Iterable[TaggedChunk]:
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    second = next(chunks, None)
+
+    if second is None or workers <= 1:
+        yield from map(tag_chunk, itertools.chain(filter(None, (first, second)), chunks))
+        return
+
+    # Spawned rather than forked: the server process has threads and open
+    # database connections that must not be duplicated into the workers
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=preload) as executor:
+        # Results come back in chunk order, with up to two chunks per worker
+        # submitted ahead of the one being waited for
+        in_flight = deque()
+        for chunk in itertools.chain((first, second), chunks):
+            in_flight.append(executor.submit(tag_chunk, chunk))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def content_hash(text: str) -> str:
+    # Same as MySQL's SHA2(text, 256)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def split_nouns(nouns: str):
+    return [noun for noun in nouns.split(', ') if noun]
+
+def refresh(workers: int = WORKERS, chunk_size: int = CHUNK_SIZE):
+    if not query('SELECT GET_LOCK(%(name)s, %(timeout)s) AS acquired', name=LOCK_NAME, timeout=LOCK_TIMEOUT).fetchone().acquired:
+        raise TimeoutError(f'Timed out waiting for lock {LOCK_NAME}.')
+
+    try:
+        removed = query(
+            '''
+                SELECT N.renter_id, N.listing_id, NULL AS comment, N.nouns AS cached_nouns
+                FROM ListingCommentNouns N
+                LEFT JOIN ListingComments LC ON LC.renter_id = N.renter_id AND LC.listing_id = N.listing_id
+                WHERE LC.comment IS NULL
+            '''
+        ).fetchall()
+        if removed:
+            apply(removed, TaggedChunk(nouns=[None] * len(removed), counts=Counter()))
+
+        # Chunks are read lazily as the taggers make progress, and applied in
+        # the order they were read
+        pending = deque()
+        def texts():
+            for comments in stale_comment_chunks(chunk_size):
+                pending.append(comments)
+                yield [comment.comment for comment in comments]
+
+        for tagged in tag_chunks(texts(), workers):
+            apply(pending.popleft(), tagged)
+    finally:
+        query('SELECT RELEASE_LOCK(%(name)s)', name=LOCK_NAME)
+
+def stale_comment_chunks(chunk_size: int):
+    # Comments that are new or whose text changed since they were tagged,
+    # paged by primary key
+    after = (0, 0)
+    while True:
+        comments = query(
+            '''
+                SELECT LC.renter_id, LC.listing_id, LC.comment, N.nouns AS cached_nouns
+                FROM ListingComments LC
+                LEFT JOIN ListingCommentNouns N ON N.renter_id = LC.renter_id AND N.listing_id = LC.listing_id
+                WHERE
+                    LC.comment IS NOT NULL AND
+                    (N.content_hash IS NULL OR N.content_hash <> SHA2(LC.comment, 256)) AND
+                    (LC.renter_id, LC.listing_id) > (%(renter_id)s, %(listing_id)s)
+                ORDER BY LC.renter_id, LC.listing_id
+                LIMIT %(limit)s
+            ''',
+            renter_id=after[0],
+            listing_id=after[1],
+            limit=chunk_size
+        ).fetchall()
+        if not comments:
+            return
+
+        yield comments
+        if len(comments) < chunk_size:
+            return
+        after = (comments[-1].renter_id, comments[-1].listing_id)
+
+def apply(comments, tagged: TaggedChunk):
+    # Stores freshly tagged nouns (or, where nouns is None, drops the cache
+    # rows of comments that are gone) and moves the noun counts accordingly
+    deltas = Counter(tagged.counts)
+    for comment in comments:
+        if comment.cached_nouns is not None:
+            deltas.subtract(split_nouns(comment.cached_nouns))
+
+    removed = [comment for (comment, nouns) in zip(comments, tagged.nouns) if nouns is None]
+    updated = [(comment, nouns) for (comment, nouns) in zip(comments, tagged.nouns) if nouns is not None]
+
+    with transaction():
+        if removed:
+            untracked_query(
+                f'''
+                    DELETE FROM ListingCommentNouns
+                    WHERE (renter_id, listing_id) IN ({', '.join(f'(%(renter_{idx})s, %(listing_{idx})s)' for idx in range(len(removed)))})
+                ''',
+                **{f'renter_{idx}': comment.renter_id for (idx, comment) in enumerate(removed)},
+                **{f'listing_{idx}': comment.listing_id for (idx, comment) in enumerate(removed)}
+            )
+
+        if updated:
+            untracked_query(
+                f'''
+                    INSERT INTO ListingCommentNouns(renter_id, listing_id, content_hash, nouns)
+                    VALUES {', '.join(f'(%(renter_{idx})s, %(listing_{idx})s, %(hash_{idx})s, %(nouns_{idx})s)' for idx in range(len(updated)))}
+                    ON DUPLICATE KEY UPDATE
+                        content_hash = VALUES(content_hash),
+                        nouns = VALUES(nouns)
+                ''',
+                **{f'renter_{idx}': comment.renter_id for (idx, (comment, _)) in enumerate(updated)},
+                **{f'listing_{idx}': comment.listing_id for (idx, (comment, _)) in enumerate(updated)},
+                **{f'hash_{idx}': content_hash(comment.comment) for (idx, (comment, _)) in enumerate(updated)},
+                **{f'nouns_{idx}': ', '.join(nouns) for (idx, (_, nouns)) in enumerate(updated)}
+            )
+
+        changed_counts = [(noun, delta) for (noun, delta) in deltas.items() if delta]
+        if changed_counts:
+            untracked_query(
+                f'''
+                    INSERT INTO ListingCommentNounCounts(noun, count)
+                    VALUES {', '.join(f'(%(noun_{idx})s, %(delta_{idx})s)' for idx in range(len(changed_counts)))}
+                    ON DUPLICATE KEY UPDATE
+                        count = count + VALUES(count)
+                ''',
+                **{f'noun_{idx}': noun for (idx, (noun, _)) in enumerate(changed_counts)},
+                **{f'delta_{idx}': delta for (idx, (_, delta)) in enumerate(changed_counts)}
+            )
+            untracked_query('DELETE FROM ListingCommentNounCounts WHERE count <= 0')
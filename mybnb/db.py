@@ -1,17 +1,263 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, NamedTuple
+
 import mysql.connector
+from mysql.connector import errorcode
+from mysql.connector.errors import PoolError, Error as MySQLError
+
+from . import instrumentation
+
+CONNECT_ARGS = dict(user='root', password='',
+                    host='127.0.0.1',
+                    database='mybnb',
+                    autocommit=True)
+
+POOL_SIZE = int(os.environ.get('MYBNB_DB_POOL_SIZE', 8))
+
+# Seconds to wait for a free connection before giving up
+CHECKOUT_TIMEOUT = float(os.environ.get('MYBNB_DB_CHECKOUT_TIMEOUT', 10))
+
+# Connections idle for longer than this many seconds are pinged before reuse
+HEALTH_CHECK_INTERVAL = float(os.environ.get('MYBNB_DB_HEALTH_CHECK_INTERVAL', 30))
+
+# Times a transaction that InnoDB rolled back to break a deadlock is run again
+DEADLOCK_RETRIES = 3
+
+class PoolStats(NamedTuple):
+    size: int
+    open: int
+    in_use: int
+    idle: int
+    checkouts: int
+    exhausted: int
+    reconnects: int
+    total_wait_seconds: float
+
+class ConnectionPool:
+    def __init__(self, size: int, **connect_args):
+        self.size = size
+        self.connect_args = connect_args
+
+        # Most recently returned connections are handed out first, so that
+        # surplus connections go idle (and get health-checked) together
+        self._idle = []
+        self._lock = threading.Lock()
+        # Notified whenever a connection is returned or discarded, as either
+        # lets a waiting thread take one
+        self._available = threading.Condition(self._lock)
+
+        self._open = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._exhausted = 0
+        self._reconnects = 0
+        self._wait_seconds = 0.0
+
+    def checkout(self, timeout: float = CHECKOUT_TIMEOUT):
+        started = time.perf_counter()
+        connection, last_used = self._take(timeout)
+        waited = time.perf_counter() - started
+
+        try:
+            if last_used is not None and time.monotonic() - last_used > HEALTH_CHECK_INTERVAL:
+                self._ensure_connected(connection)
+        except MySQLError:
+            self._discard(connection)
+            raise
+
+        with self._lock:
+            self._checkouts += 1
+            self._wait_seconds += waited
+        return connection
+
+    def checkin(self, connection):
+        try:
+            if connection.unread_result:
+                connection.consume_results()
+            if connection.in_transaction:
+                connection.rollback()
+        except MySQLError:
+            self._discard(connection)
+            return
+
+        with self._available:
+            self._in_use -= 1
+            self._idle.append((connection, time.monotonic()))
+            self._available.notify()
+
+    def stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(
+                size=self.size,
+                open=self._open,
+                in_use=self._in_use,
+                idle=self._open - self._in_use,
+                checkouts=self._checkouts,
+                exhausted=self._exhausted,
+                reconnects=self._reconnects,
+                total_wait_seconds=self._wait_seconds,
+            )
+
+    def _take(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        waited = False
+        with self._available:
+            while True:
+                if self._idle:
+                    self._in_use += 1
+                    return self._idle.pop()
+
+                # Also after waking up, as a discarded connection frees up
+                # room for a new one rather than returning one to take
+                if self._open < self.size:
+                    self._open += 1
+                    self._in_use += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError(f'No database connection became free within {timeout}s (pool size {self.size}).')
+                if not waited:
+                    waited = True
+                    self._exhausted += 1
+                self._available.wait(remaining)
+
+        try:
+            return mysql.connector.connect(**self.connect_args), None
+        except MySQLError:
+            self._forget_one()
+            raise
 
-connection = mysql.connector.connect(user='root', password='',
-                                     host='127.0.0.1',
-                                     database='mybnb',
-                                     autocommit=True)
+    def _ensure_connected(self, connection):
+        if not connection.is_connected():
+            connection.reconnect(attempts=2, delay=0)
+            with self._lock:
+                self._reconnects += 1
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except MySQLError:
+            pass
+
+        self._forget_one()
+
+    def _forget_one(self):
+        with self._available:
+            self._open -= 1
+            self._in_use -= 1
+            self._available.notify()
+
+pool = ConnectionPool(POOL_SIZE, **CONNECT_ARGS)
+
+# Each thread (i.e., each request being served) holds at most one connection
+_local = threading.local()
+
+def connection():
+    if getattr(_local, 'connection', None) is None:
+        _local.connection = pool.checkout()
+    return _local.connection
+
+def release():
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        return
+
+    _local.connection = None
+    try:
+        if getattr(_local, 'wrote', False):
+            _local.wrote = False
+            _bump_data_version(connection)
+    finally:
+        pool.checkin(connection)
+
+# Bumped once per request (or other unit of work) that wrote anything, so
+# that derived results such as cached reports can tell they are stale
+def data_version():
+    row = query('SELECT version FROM DataVersion').fetchone()
+    return row.version if row else None
+
+def _bump_data_version(connection):
+    cursor = connection.cursor()
+    cursor.execute('UPDATE DataVersion SET version = version + 1')
+    cursor.close()
+
+def _is_write(sql: str) -> bool:
+    return sql.lstrip()[:7].upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'REPLACE'))
+
+def init_app(app):
+    # Connections are checked out lazily by the first query of a request
+    # and returned to the pool once the request is torn down
+    @app.teardown_appcontext
+    def release_connection(exception=None):
+        release()
+
+@contextmanager
+def transaction():
+    conn = connection()
+
+    # Nested transactions join the outermost one
+    if conn.in_transaction:
+        yield
+        return
+
+    conn.start_transaction()
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+def retrying_deadlocks(attempt: Callable, retries: int = DEADLOCK_RETRIES):
+    # Runs attempt(), which does its work in a transaction(), again if InnoDB
+    # chose it as a deadlock victim and rolled it back. Within an outer
+    # transaction it runs once, as only the outermost one can be run again.
+    nested = connection().in_transaction
+    for retry in range(retries + 1):
+        try:
+            return attempt()
+        except MySQLError as e:
+            if nested or e.errno != errorcode.ER_LOCK_DEADLOCK or retry == retries:
+                raise
+        # A little apart, so that the same transactions don't collide again
+        time.sleep(random.uniform(0, 0.01 * 2 ** retry))
+
+@contextmanager
+def temporary_table(name: str, columns_sql: str):
+    # Temporary tables belong to the connection, which goes back to the pool
+    # afterwards, so they are dropped again rather than left for the session
+    query(f'DROP TEMPORARY TABLE IF EXISTS {name}')
+    query(f'CREATE TEMPORARY TABLE {name} ({columns_sql})')
+    try:
+        yield
+    finally:
+        query(f'DROP TEMPORARY TABLE IF EXISTS {name}')
+
+def untracked_query(sql: str, **env):
+    # For writes that no derived result depends on, such as sessions, and
+    # that therefore don't bump the data version
+    wrote = getattr(_local, 'wrote', False)
+    try:
+        return query(sql, **env)
+    finally:
+        _local.wrote = wrote
 
 def query(sql: str, **env):
-    print(trim_lines(sql % env))
+    started = time.perf_counter()
 
-    global connection
-    cursor = connection.cursor(named_tuple=True)
+    # Buffered, so that no unread results are left behind on the connection
+    # when callers only fetch part of a result set
+    cursor = connection().cursor(named_tuple=True, buffered=True)
     cursor.execute(sql, env)
-    return cursor
+    if _is_write(sql):
+        _local.wrote = True
 
-def trim_lines(text: str):
-    return '\n'.join([line.strip() for line in text.split('\n')])
+    instrumentation.record(sql, env, time.perf_counter() - started, cursor.rowcount,
+                           caller=instrumentation.calling_function())
+    return cursor
@@ -0,0 +1,21 @@
+import math
+
+# Kilometres per degree of latitude (and of longitude at the equator)
+KM_PER_DEGREE = 111.111
+
+def bounding_box(lat: float, lon: float, distance: float):
+    # Degrees around (lat, lon) that contain every point within distance km;
+    # the longitude range is None where it would wrap around a pole or the
+    # antimeridian
+    lat_delta = distance / KM_PER_DEGREE
+    (min_lat, max_lat) = (lat - lat_delta, lat + lat_delta)
+
+    widest_lat = min(max(abs(min_lat), abs(max_lat)), 90)
+    if widest_lat >= 90:
+        return (min_lat, max_lat), None
+
+    lon_delta = lat_delta / math.cos(math.radians(widest_lat))
+    if lon - lon_delta < -180 or lon + lon_delta > 180:
+        return (min_lat, max_lat), None
+
+    return (min_lat, max_lat), (lon - lon_delta, lon + lon_delta)
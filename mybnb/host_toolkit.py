@@ -2,36 +2,48 @@ from typing import NamedTuple, Optional
 from datetime import date
 from flask import session
 
+from . import price_stats, amenities
 from .db import query
 from .tables.listings import Listing
 from .consts import AMENITIES_CHOICES
 
+# Number of the listing's existing amenities that a row's listing also has;
+# the empty amenity of a listing without amenities matches every row
+COMMON_AMENITIES_COUNT_SQL = 'BIT_COUNT(amenity_bits & %(amenity_bits)s) + %(blank_amenities)s'
+
+def common_amenities_count_params(existing_amenities):
+    return {
+        'amenity_bits': amenities.bitmask(existing_amenities),
+        'blank_amenities': existing_amenities.count('')
+    }
+
 def suggest_price(listing: Listing, simulate_extra_amenities=[]):
-    existing_amenities = listing.amenities.split(', ')
+    existing_amenities = amenities.split(listing.amenities)
     if simulate_extra_amenities:
         existing_amenities.extend(simulate_extra_amenities)
 
+    sums = price_stats.sums_excluding_listing(listing.id)
+    if sums and sums.covers(existing_amenities):
+        return sums.expected_price(existing_amenities)
+
     # Mean (computed as weighted average) of rental price per existing amenity
-    common_amenities_count_sql = (
-        ' + '.join(f'(amenities LIKE %(amenity_{idx})s)' for idx in range(len(existing_amenities)))
-    )
     return query(
         f'''
             WITH
                 A AS (
-                    SELECT L.id AS listing_id, L.amenities, A.rental_price
+                    SELECT L.id AS listing_id, L.amenity_bits, A.rental_price
                     FROM Availability A
                     JOIN BookingSlots S ON S.id = A.slot_id
                     JOIN Listings L ON L.id = S.listing_id
                     WHERE L.id <> %(listing_id)s
                 ),
                 WeightedSums AS (
-                    SELECT listing_id, SUM(A.rental_price * ({common_amenities_count_sql})) AS value
+                    SELECT listing_id, SUM(A.rental_price * ({COMMON_AMENITIES_COUNT_SQL})) AS value
                     FROM A
                     GROUP BY listing_id
                 ),
                 Sums AS (
-                    SELECT listing_id, SUM({common_amenities_count_sql}) AS value
+                    SELECT listing_id, SUM({COMMON_AMENITIES_COUNT_SQL}) AS value
                     FROM A
                     GROUP BY listing_id
                 )
@@ -40,18 +52,25 @@ def suggest_price(listing: Listing, simulate_extra_amenities=[]):
             WHERE WeightedSums.listing_id = Sums.listing_id
         ''',
         listing_id=listing.id,
-        **{
-            
-            f'amenity_{idx}': f'%{amenity}%'
-            for (idx, amenity) in enumerate(existing_amenities)
-        }
+        **common_amenities_count_params(existing_amenities)
     ).fetchall()[0].expected_price
 
 def suggest_amenities(listing: Listing):
-    existing_amenities = listing.amenities.split(', ')
+    existing_amenities = amenities.split(listing.amenities)
+    candidate_amenities = [amenity for amenity in AMENITIES_CHOICES if amenity not in existing_amenities]
+
+    sums = price_stats.sums_excluding_listing(listing.id)
+    if sums and sums.covers(existing_amenities):
+        expected_current_revenue = sums.expected_price(existing_amenities)
+        expected_prices = [
+            sums.expected_price([*existing_amenities, amenity])
+            for amenity in candidate_amenities
+        ]
+    else:
+        expected_current_revenue, expected_prices = scan_expected_prices(listing, existing_amenities, candidate_amenities)
 
-    expected_current_revenue = suggest_price(listing)
-    print('Expected current revenue:', expected_current_revenue, '\n')
+    if expected_current_revenue is None:
+        return []
 
     class AmenitySuggestion(NamedTuple):
         amenity: str
@@ -63,13 +82,60 @@ def suggest_amenities(listing: Listing):
             for suggestion in (
                 AmenitySuggestion(
                     amenity=amenity,
-                    expected_revenue_increase=(suggest_price(listing, simulate_extra_amenities=[amenity]) - expected_current_revenue)
+                    expected_revenue_increase=(expected_price - expected_current_revenue)
                 )
-                for amenity in AMENITIES_CHOICES
-                if amenity not in existing_amenities
+                for (amenity, expected_price) in zip(candidate_amenities, expected_prices)
             )
             if suggestion.expected_revenue_increase > 0
         ),
         key=lambda suggestion: suggestion.expected_revenue_increase,
         reverse=True
     )
+
+def scan_expected_prices(listing: Listing, existing_amenities, candidate_amenities):
+    # Same weighted average as suggest_price, but the baseline and every
+    # candidate amenity are summed up in a single scan: adding amenity c
+    # contributes 1 to the common amenity count of each row whose listing has
+    # c, so its expected price is (W + W_c) / (N + N_c)
+    candidate_sums_sql = ''.join(
+        f""",
+                        SUM(rental_price * ((amenity_bits & %(candidate_{idx})s) <> 0)) AS weighted_sum_{idx},
+                        SUM((amenity_bits & %(candidate_{idx})s) <> 0) AS amenity_count_{idx}"""
+        for idx in range(len(candidate_amenities))
+    )
+    candidate_prices_sql = ''.join(
+        f""",
+                (weighted_sum + weighted_sum_{idx}) / (amenity_count + amenity_count_{idx}) AS expected_price_{idx}"""
+        for idx in range(len(candidate_amenities))
+    )
+    prices = query(
+        f'''
+            WITH
+                A AS (
+                    SELECT L.amenity_bits, A.rental_price
+                    FROM Availability A
+                    JOIN BookingSlots S ON S.id = A.slot_id
+                    JOIN Listings L ON L.id = S.listing_id
+                    WHERE L.id <> %(listing_id)s
+                ),
+                Sums AS (
+                    SELECT
+                        SUM(rental_price * ({COMMON_AMENITIES_COUNT_SQL})) AS weighted_sum,
+                        SUM({COMMON_AMENITIES_COUNT_SQL}) AS amenity_count{candidate_sums_sql}
+                    FROM A
+                )
+            SELECT weighted_sum / amenity_count AS expected_price{candidate_prices_sql}
+            FROM Sums
+        ''',
+        listing_id=listing.id,
+        **common_amenities_count_params(existing_amenities),
+        **{
+            f'candidate_{idx}': amenities.BITS[amenity]
+            for (idx, amenity) in enumerate(candidate_amenities)
+        }
+    ).fetchone()
+
+    return prices.expected_price, [
+        getattr(prices, f'expected_price_{idx}')
+        for idx in range(len(candidate_amenities))
+    ]
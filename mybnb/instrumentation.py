@@ -0,0 +1,157 @@
+import functools
+import logging
+import os
+import random
+import re
+import sys
+import threading
+from typing import NamedTuple
+
+from flask import request
+from flask.logging import default_handler
+
+logger = logging.getLogger('mybnb.queries')
+
+# Fraction of statements (and request rollups) that get logged: 0 disables
+# logging entirely, 1 logs everything. Can be changed while serving.
+log_sample_rate = float(os.environ.get('MYBNB_QUERY_LOG_SAMPLE_RATE', 0))
+
+def set_log_sample_rate(rate: float):
+    global log_sample_rate
+    log_sample_rate = min(max(rate, 0.0), 1.0)
+
+def should_log() -> bool:
+    return log_sample_rate > 0 and (log_sample_rate >= 1 or random.random() < log_sample_rate)
+
+class FingerprintStats(NamedTuple):
+    fingerprint: str
+    calls: int
+    total_ms: float
+    mean_ms: float
+    max_ms: float
+    rows: int
+    callers: str
+
+class RequestRollup(NamedTuple):
+    queries: int
+    total_ms: float
+    rows: int
+    slowest_fingerprint: str
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql: str) -> str:
+    sql = re.sub(r'%\(\w+\)s', '?', sql)
+    sql = re.sub(r"'(?:[^'\\]|\\.)*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(...)', sql)
+    return ' '.join(sql.split())
+
+def calling_function() -> str:
+    # Attribute the statement to the nearest mybnb function outside the
+    # data access layer, e.g. 'tables.listings.search' or 'reports.top_renters'
+    frame = sys._getframe(1)
+    while frame:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('mybnb.') and module not in ('mybnb.db', __name__):
+            return f"{module.removeprefix('mybnb.')}.{frame.f_code.co_qualname}"
+        frame = frame.f_back
+    return '?'
+
+_lock = threading.Lock()
+_totals = {}
+_local = threading.local()
+
+# One statement with its parameters per fingerprint, for tools that look at
+# query plans (benchmarks/query_plans.py); off unless enabled
+_samples = None
+
+def capture_samples(enabled: bool = True):
+    global _samples
+    _samples = {} if enabled else None
+
+def samples() -> dict:
+    # {fingerprint: (sql, env, caller)}
+    with _lock:
+        return dict(_samples or {})
+
+def record(sql: str, env: dict, seconds: float, rows: int, caller: str):
+    key = fingerprint(sql)
+    rows = max(rows, 0)
+
+    with _lock:
+        totals = _totals.get(key)
+        if totals is None:
+            totals = _totals[key] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'callers': set()}
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        totals['max_seconds'] = max(totals['max_seconds'], seconds)
+        totals['rows'] += rows
+        totals['callers'].add(caller)
+        if _samples is not None and key not in _samples:
+            _samples[key] = (sql, dict(env), caller)
+
+    request_queries = getattr(_local, 'queries', None)
+    if request_queries is not None:
+        request_queries.append((key, seconds, rows))
+
+    if should_log():
+        logger.info('%.1f ms, %d rows, %s: %s', seconds * 1000, rows, caller, render(sql, env))
+
+def render(sql: str, env: dict) -> str:
+    try:
+        return ' '.join((sql % env).split())
+    except (KeyError, TypeError, ValueError):
+        return ' '.join(sql.split())
+
+def top_fingerprints(limit: int = 25) -> list[FingerprintStats]:
+    with _lock:
+        snapshot = [(key, dict(totals, callers=sorted(totals['callers']))) for (key, totals) in _totals.items()]
+
+    return [
+        FingerprintStats(
+            fingerprint=key,
+            calls=totals['calls'],
+            total_ms=totals['seconds'] * 1000,
+            mean_ms=totals['seconds'] * 1000 / totals['calls'],
+            max_ms=totals['max_seconds'] * 1000,
+            rows=totals['rows'],
+            callers=', '.join(totals['callers']),
+        )
+        for (key, totals) in sorted(snapshot, key=lambda item: item[1]['seconds'], reverse=True)[:limit]
+    ]
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+def begin_request():
+    _local.queries = []
+
+def end_request() -> RequestRollup:
+    queries = getattr(_local, 'queries', None) or []
+    _local.queries = None
+
+    slowest = max(queries, key=lambda query: query[1], default=None)
+    return RequestRollup(
+        queries=len(queries),
+        total_ms=sum(seconds for (_, seconds, _) in queries) * 1000,
+        rows=sum(rows for (_, _, rows) in queries),
+        slowest_fingerprint=(slowest[0] if slowest else ''),
+    )
+
+def init_app(app):
+    if not logger.handlers:
+        logger.addHandler(default_handler)
+        logger.setLevel(logging.INFO)
+
+    @app.before_request
+    def begin_request_rollup():
+        begin_request()
+
+    @app.teardown_request
+    def end_request_rollup(exception=None):
+        rollup = end_request()
+        if rollup.queries and should_log():
+            logger.info('%s %s: %d queries, %.1f ms, %d rows; slowest: %s',
+                        request.method, request.path,
+                        rollup.queries, rollup.total_ms, rollup.rows, rollup.slowest_fingerprint)
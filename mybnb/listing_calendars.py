@@ -0,0 +1,242 @@
+import sys
+from datetime import date, timedelta
+
+from .db import query, transaction, release
+
+# ListingCalendars holds one bitmap per listing of the nights it is open
+# (available and not booked) over the HORIZON_DAYS nights from starts_on, so
+# that "open every night from A to B" is a single AND of the bitmap with a
+# mask rather than a count over BookingSlots, Availability and Bookings. Bit
+# i, counting from the most significant bit of the first byte, is the night
+# starts_on + i, so that MySQL's binary string shifts move the window by
+# whole nights.
+#
+# Bitmaps are recomputed from those tables by the write paths, after the
+# write and in the same transaction; listings without a row have no open
+# nights in the horizon. A write recomputes only the listings it touched, so
+# those rows start today; the others are rolled forward by roll(), which only
+# the `roll` command runs (say, daily from cron). Searches shift rows that
+# weren't rolled yet on the fly and count the nights past their end instead.
+HORIZON_DAYS = 384
+CALENDAR_BYTES = HORIZON_DAYS // 8
+
+# Roll at most this many listings per statement
+ROLL_BATCH_SIZE = 1000
+
+def refresh_listings(listing_ids_sql: str, **env):
+    query(
+        f'''
+            INSERT INTO ListingCalendars(listing_id, starts_on, open_nights)
+            SELECT
+                L.id,
+                %(calendar_today)s,
+                BIT_OR(
+                    CASE
+                        WHEN A.id IS NOT NULL AND B.id IS NULL
+                        THEN UNHEX(CONCAT('80', REPEAT('00', %(calendar_bytes)s - 1))) >> DATEDIFF(S.date, %(calendar_today)s)
+                        ELSE UNHEX(REPEAT('00', %(calendar_bytes)s))
+                    END
+                )
+            FROM Listings L
+            LEFT JOIN BookingSlots S
+                ON S.listing_id = L.id
+                AND S.date >= %(calendar_today)s
+                AND S.date < %(calendar_today)s + INTERVAL %(calendar_days)s DAY
+            LEFT JOIN AvailabilityLive A ON A.slot_id = S.id
+            LEFT JOIN BookingsLive B ON B.availability_id = A.id
+            WHERE L.id IN ({listing_ids_sql})
+            GROUP BY L.id
+            ON DUPLICATE KEY UPDATE
+                starts_on = VALUES(starts_on),
+                open_nights = VALUES(open_nights)
+        ''',
+        calendar_today=date.today(),
+        calendar_bytes=CALENDAR_BYTES,
+        calendar_days=HORIZON_DAYS,
+        **env
+    )
+
+def refresh_slots(slot_ids_sql: str, **env):
+    # Must run after the write, but before any of the slots are deleted
+    refresh_listings(f'SELECT listing_id FROM BookingSlots WHERE id IN ({slot_ids_sql})', **env)
+
+def refresh_listing_ids(listing_ids: list):
+    # For listing ids read before a write that removes what they were found by
+    for start in range(0, len(listing_ids), ROLL_BATCH_SIZE):
+        batch = listing_ids[start:start + ROLL_BATCH_SIZE]
+        refresh_listings(
+            ', '.join(f'%(listing_id_{idx})s' for idx in range(len(batch))),
+            **{f'listing_id_{idx}': listing_id for (idx, listing_id) in enumerate(batch)}
+        )
+
+def close_nights(nights_by_listing: dict):
+    # Clears the bits of newly booked nights, {listing_id: [date, ...]},
+    # touching nothing but the listings' calendar rows. Bookings use this
+    # rather than refresh_listings(), whose INSERT ... SELECT would take
+    # shared locks on every slot, availability and booking of the listing,
+    # so that concurrent bookers of other nights would deadlock on them.
+    today = date.today()
+    for (listing_id, nights) in sorted(nights_by_listing.items()):
+        # Relative to today, then shifted to the row's own starts_on
+        bits = 0
+        for night in nights:
+            offset = (night - today).days
+            if 0 <= offset < HORIZON_DAYS:
+                bits |= 1 << (HORIZON_DAYS - 1 - offset)
+        if not bits:
+            continue
+        query(
+            '''
+                UPDATE ListingCalendars
+                SET
+                    open_nights = open_nights & ~(UNHEX(%(mask)s) >> DATEDIFF(%(today)s, starts_on))
+                WHERE listing_id = %(listing_id)s
+            ''',
+            mask=bits.to_bytes(CALENDAR_BYTES, 'big').hex(),
+            today=today,
+            listing_id=listing_id
+        )
+
+def roll():
+    # Recomputes the calendars that start before today, so that every one
+    # covers the same HORIZON_DAYS nights; only writes if there are any
+    stale_ids = [
+        row.listing_id
+        for row in query(
+            'SELECT listing_id FROM ListingCalendars WHERE starts_on < %(today)s',
+            today=date.today()
+        )
+    ]
+    if stale_ids:
+        with transaction():
+            refresh_listing_ids(stale_ids)
+
+def rebuild():
+    # Recomputes every calendar, e.g. after populating the database
+    with transaction():
+        query('DELETE FROM ListingCalendars')
+        refresh_listings('SELECT id FROM Listings')
+
+def covers(start_date: date, end_date: date) -> bool:
+    today = date.today()
+    return today <= start_date <= end_date < today + timedelta(days=HORIZON_DAYS)
+
+def stay_sql(listing_id_sql: str, start_date: date, end_date: date, prefix: str = 'stay') -> tuple[str, dict]:
+    # Condition that the listing is open every night from start_date to
+    # end_date, and its parameters. Ranges outside the horizon are counted
+    # night by night instead.
+    nights = (end_date - start_date).days + 1
+    env = {
+        f'{prefix}_start': start_date,
+        f'{prefix}_end': end_date,
+        f'{prefix}_nights': nights,
+    }
+    count_sql = f'''(
+            SELECT COUNT(DISTINCT S.id)
+            FROM BookingSlots S
+            JOIN AvailabilityLive A ON A.slot_id = S.id
+            LEFT JOIN BookingsLive B ON B.availability_id = A.id
+            WHERE
+                S.listing_id = {listing_id_sql} AND
+                S.date BETWEEN %({prefix}_start)s AND %({prefix}_end)s AND
+                B.id IS NULL
+        ) = %({prefix}_nights)s'''
+    if not covers(start_date, end_date):
+        return count_sql, env
+
+    # Rows not rolled yet are shifted to start today on the fly. They end
+    # before today's horizon does, so stays running past the end of a row
+    # are counted night by night like those outside the horizon.
+    today = date.today()
+    env[f'{prefix}_today'] = today
+    env[f'{prefix}_days'] = HORIZON_DAYS
+    env[f'{prefix}_mask'] = nights_mask(today, start_date, end_date).hex()
+    return f'''({listing_id_sql} IN (
+        SELECT listing_id
+        FROM ListingCalendars
+        WHERE
+            starts_on > %({prefix}_end)s - INTERVAL %({prefix}_days)s DAY AND
+            (open_nights << DATEDIFF(%({prefix}_today)s, starts_on)) & UNHEX(%({prefix}_mask)s)
+                = UNHEX(%({prefix}_mask)s)
+    ) OR (
+        {listing_id_sql} IN (
+            SELECT listing_id
+            FROM ListingCalendars
+            WHERE starts_on <= %({prefix}_end)s - INTERVAL %({prefix}_days)s DAY
+        ) AND
+        {count_sql}
+    ))''', env
+
+def nights_mask(starts_on: date, start_date: date, end_date: date) -> bytes:
+    # Bits of the nights from start_date to end_date in a calendar starting on
+    # starts_on
+    offset = (start_date - starts_on).days
+    nights = (end_date - start_date).days + 1
+    return (((1 << nights) - 1) << (HORIZON_DAYS - offset - nights)).to_bytes(CALENDAR_BYTES, 'big')
+
+def dates(starts_on: date, open_nights: bytes) -> list[date]:
+    bits = int.from_bytes(open_nights, 'big')
+    return [
+        starts_on + timedelta(days=idx)
+        for idx in range(HORIZON_DAYS)
+        if bits >> (HORIZON_DAYS - 1 - idx) & 1
+    ]
+
+def open_dates(listing_id) -> set[date]:
+    calendar = query(
+        'SELECT starts_on, open_nights FROM ListingCalendars WHERE listing_id = %(listing_id)s',
+        listing_id=listing_id
+    ).fetchone()
+    return set(dates(calendar.starts_on, bytes(calendar.open_nights))) if calendar else set()
+
+def check() -> list[str]:
+    # Compares every calendar with the open nights in BookingSlots,
+    # Availability and Bookings over its horizon, returning the differences
+    today = date.today()
+    calendars = {
+        row.listing_id: (row.starts_on, set(dates(row.starts_on, bytes(row.open_nights))))
+        for row in query('SELECT listing_id, starts_on, open_nights FROM ListingCalendars')
+    }
+    expected = {}
+    for night in query(
+        '''
+            SELECT DISTINCT S.listing_id, S.date
+            FROM BookingSlots S
+            JOIN AvailabilityLive A ON A.slot_id = S.id
+            LEFT JOIN BookingsLive B ON B.availability_id = A.id
+            WHERE S.date >= %(since)s AND B.id IS NULL
+        ''',
+        since=min([today, *(starts_on for (starts_on, _) in calendars.values())])
+    ):
+        starts_on = calendars.get(night.listing_id, (today, None))[0]
+        if starts_on <= night.date < starts_on + timedelta(days=HORIZON_DAYS):
+            expected.setdefault(night.listing_id, set()).add(night.date)
+
+    differences = []
+    for listing_id in sorted({*calendars, *expected}):
+        found = calendars.get(listing_id, (today, set()))[1]
+        missing = sorted(expected.get(listing_id, set()) - found)
+        extra = sorted(found - expected.get(listing_id, set()))
+        if missing:
+            differences.append(f'Listing {listing_id}: open but not in the calendar: {", ".join(map(str, missing))}')
+        if extra:
+            differences.append(f'Listing {listing_id}: in the calendar but not open: {", ".join(map(str, extra))}')
+    return differences
+
+if __name__ == '__main__':
+    if sys.argv[1:] not in (['rebuild'], ['roll'], ['check']):
+        sys.exit(f'usage: python -m {__spec__.name} rebuild|roll|check')
+
+    try:
+        if sys.argv[1] == 'rebuild':
+            rebuild()
+        elif sys.argv[1] == 'roll':
+            roll()
+        else:
+            differences = check()
+            for difference in differences:
+                print(difference)
+            print(f'{len(differences)} difference(s) found.')
+            sys.exit(1 if differences else 0)
+    finally:
+        release()
@@ -0,0 +1,275 @@
+import sys
+from typing import Optional
+
+from . import amenities
+from .db import query, transaction, release
+from .consts import AMENITIES_CHOICES
+
+# Statistics behind host_toolkit.suggest_price, kept in AmenityPriceTotals
+# (per amenity, over all Availability rows) and AmenityPriceContributions
+# (the same sums restricted to one listing). An amenity's row covers every
+# Availability row whose listing has the amenity's bit, which is exactly the
+# match suggest_price counts; the empty amenity has no bit and matches all rows.
+VOCABULARY = ['', *AMENITIES_CHOICES]
+
+class AmenitySums:
+    def __init__(self, weighted_sums: dict, counts: dict):
+        self.weighted_sums = weighted_sums
+        self.counts = counts
+
+    def covers(self, amenities) -> bool:
+        return all(amenity in self.counts for amenity in amenities)
+
+    def expected_price(self, amenities) -> Optional[float]:
+        count = sum(self.counts[amenity] for amenity in amenities)
+        if not count:
+            return None
+        return sum(self.weighted_sums[amenity] for amenity in amenities) / count
+
+def sums_excluding_listing(listing_id) -> Optional[AmenitySums]:
+    rows = query(
+        '''
+            SELECT
+                T.amenity,
+                T.weighted_sum - COALESCE(C.weighted_sum, 0) AS weighted_sum,
+                T.count - COALESCE(C.count, 0) AS count
+            FROM AmenityPriceTotals T
+            LEFT JOIN AmenityPriceContributions C ON C.amenity = T.amenity AND C.listing_id = %(listing_id)s
+        ''',
+        listing_id=listing_id
+    ).fetchall()
+
+    # Not built yet (see rebuild())
+    if not rows:
+        return None
+
+    return AmenitySums(
+        weighted_sums={row.amenity: row.weighted_sum for row in rows},
+        counts={row.amenity: row.count for row in rows}
+    )
+
+def record_availability(slot_id, rental_price):
+    with transaction():
+        query(
+            '''
+                INSERT INTO AmenityPriceContributions(listing_id, amenity, weighted_sum, count)
+                SELECT S.listing_id, T.amenity, %(rental_price)s, 1
+                FROM BookingSlots S
+                JOIN Listings L ON L.id = S.listing_id
+                JOIN AmenityPriceTotals T ON (L.amenity_bits & T.bit) = T.bit
+                WHERE S.id = %(slot_id)s
+                ON DUPLICATE KEY UPDATE
+                    weighted_sum = AmenityPriceContributions.weighted_sum + VALUES(weighted_sum),
+                    count = AmenityPriceContributions.count + VALUES(count)
+            ''',
+            slot_id=slot_id,
+            rental_price=rental_price
+        )
+        query(
+            '''
+                UPDATE AmenityPriceTotals T
+                JOIN BookingSlots S ON S.id = %(slot_id)s
+                JOIN Listings L ON L.id = S.listing_id
+                SET
+                    T.weighted_sum = T.weighted_sum + %(rental_price)s,
+                    T.count = T.count + 1
+                WHERE (L.amenity_bits & T.bit) = T.bit
+            ''',
+            slot_id=slot_id,
+            rental_price=rental_price
+        )
+
+def record_prices(prices_sql: str, **env):
+    # Set-based record_availability(); prices_sql selects the new
+    # Availability rows as (slot_id, rental_price)
+    with transaction():
+        query(
+            f'''
+                INSERT INTO AmenityPriceContributions(listing_id, amenity, weighted_sum, count)
+                SELECT S.listing_id, T.amenity, SUM(P.rental_price), COUNT(*)
+                FROM ({prices_sql}) P
+                JOIN BookingSlots S ON S.id = P.slot_id
+                JOIN Listings L ON L.id = S.listing_id
+                JOIN AmenityPriceTotals T ON (L.amenity_bits & T.bit) = T.bit
+                GROUP BY S.listing_id, T.amenity
+                ON DUPLICATE KEY UPDATE
+                    weighted_sum = AmenityPriceContributions.weighted_sum + VALUES(weighted_sum),
+                    count = AmenityPriceContributions.count + VALUES(count)
+            ''',
+            **env
+        )
+
+        # Each totals row is updated once per statement, so the prices are
+        # summed per amenity first; the listings' contribution rows (which
+        # exist now) give their amenities
+        query(
+            f'''
+                UPDATE AmenityPriceTotals T
+                JOIN (
+                    SELECT C.amenity, SUM(P.rental_price) AS weighted_sum, COUNT(*) AS count
+                    FROM ({prices_sql}) P
+                    JOIN BookingSlots S ON S.id = P.slot_id
+                    JOIN AmenityPriceContributions C ON C.listing_id = S.listing_id
+                    GROUP BY C.amenity
+                ) D ON D.amenity = T.amenity
+                SET
+                    T.weighted_sum = T.weighted_sum + D.weighted_sum,
+                    T.count = T.count + D.count
+            ''',
+            **env
+        )
+
+def forget_slots(slot_ids_sql: str, **env):
+    # Must run before the slots (and, by cascade, their Availability) are
+    # deleted
+    slot_sums_sql = f'''
+        SELECT S.listing_id, SUM(A.rental_price) AS weighted_sum, COUNT(*) AS count
+        FROM BookingSlots S
+        JOIN Availability A ON A.slot_id = S.id
+        WHERE S.id IN ({slot_ids_sql})
+        GROUP BY S.listing_id
+    '''
+
+    with transaction():
+        query(
+            f'''
+                UPDATE AmenityPriceTotals T
+                JOIN (
+                    SELECT C.amenity, SUM(D.weighted_sum) AS weighted_sum, SUM(D.count) AS count
+                    FROM ({slot_sums_sql}) D
+                    JOIN AmenityPriceContributions C ON C.listing_id = D.listing_id
+                    GROUP BY C.amenity
+                ) D ON D.amenity = T.amenity
+                SET
+                    T.weighted_sum = T.weighted_sum - D.weighted_sum,
+                    T.count = T.count - D.count
+            ''',
+            **env
+        )
+        query(
+            f'''
+                UPDATE AmenityPriceContributions C
+                JOIN ({slot_sums_sql}) D ON D.listing_id = C.listing_id
+                SET
+                    C.weighted_sum = C.weighted_sum - D.weighted_sum,
+                    C.count = C.count - D.count
+            ''',
+            **env
+        )
+
+def forget_slot(slot_id):
+    forget_slots('%(slot_id)s', slot_id=slot_id)
+
+def forget_listings(listing_ids_sql: str, **env):
+    # Must run before the listings are deleted; their contribution rows
+    # would otherwise vanish by cascade without leaving the totals
+    with transaction():
+        query(
+            f'''
+                UPDATE AmenityPriceTotals T
+                JOIN (
+                    SELECT amenity, SUM(weighted_sum) AS weighted_sum, SUM(count) AS count
+                    FROM AmenityPriceContributions
+                    WHERE listing_id IN ({listing_ids_sql})
+                    GROUP BY amenity
+                ) C ON C.amenity = T.amenity
+                SET
+                    T.weighted_sum = T.weighted_sum - C.weighted_sum,
+                    T.count = T.count - C.count
+            ''',
+            **env
+        )
+        query(
+            f'''
+                DELETE FROM AmenityPriceContributions
+                WHERE listing_id IN ({listing_ids_sql})
+            ''',
+            **env
+        )
+
+def forget_listing(listing_id):
+    forget_listings('%(listing_id)s', listing_id=listing_id)
+
+def forget_listings_owned_by(owner_id):
+    forget_listings('SELECT id FROM Listings WHERE owner_id = %(owner_id)s', owner_id=owner_id)
+
+def refresh_listing(listing_id):
+    with transaction():
+        forget_listing(listing_id)
+        query(
+            '''
+                INSERT INTO AmenityPriceContributions(listing_id, amenity, weighted_sum, count)
+                SELECT L.id, T.amenity, SUM(A.rental_price), COUNT(*)
+                FROM Listings L
+                JOIN BookingSlots S ON S.listing_id = L.id
+                JOIN Availability A ON A.slot_id = S.id
+                JOIN AmenityPriceTotals T ON (L.amenity_bits & T.bit) = T.bit
+                WHERE L.id = %(listing_id)s
+                GROUP BY L.id, T.amenity
+            ''',
+            listing_id=listing_id
+        )
+        query(
+            '''
+                UPDATE AmenityPriceTotals T
+                JOIN AmenityPriceContributions C ON C.amenity = T.amenity
+                SET
+                    T.weighted_sum = T.weighted_sum + C.weighted_sum,
+                    T.count = T.count + C.count
+                WHERE C.listing_id = %(listing_id)s
+            ''',
+            listing_id=listing_id
+        )
+
+def rebuild():
+    with transaction():
+        query('DELETE FROM AmenityPriceContributions')
+        query('DELETE FROM AmenityPriceTotals')
+
+        query(
+            f'''
+                INSERT INTO AmenityPriceTotals(amenity, bit, weighted_sum, count)
+                VALUES {', '.join(f'(%(amenity_{idx})s, %(bit_{idx})s, 0, 0)' for idx in range(len(VOCABULARY)))}
+            ''',
+            **{
+                f'amenity_{idx}': amenity
+                for (idx, amenity) in enumerate(VOCABULARY)
+            },
+            **{
+                f'bit_{idx}': amenities.BITS.get(amenity, 0)
+                for (idx, amenity) in enumerate(VOCABULARY)
+            }
+        )
+        query(
+            '''
+                INSERT INTO AmenityPriceContributions(listing_id, amenity, weighted_sum, count)
+                SELECT L.id, T.amenity, SUM(A.rental_price), COUNT(*)
+                FROM Listings L
+                JOIN BookingSlots S ON S.listing_id = L.id
+                JOIN Availability A ON A.slot_id = S.id
+                JOIN AmenityPriceTotals T ON (L.amenity_bits & T.bit) = T.bit
+                GROUP BY L.id, T.amenity
+            '''
+        )
+        query(
+            '''
+                UPDATE AmenityPriceTotals T
+                JOIN (
+                    SELECT amenity, SUM(weighted_sum) AS weighted_sum, SUM(count) AS count
+                    FROM AmenityPriceContributions
+                    GROUP BY amenity
+                ) C ON C.amenity = T.amenity
+                SET
+                    T.weighted_sum = C.weighted_sum,
+                    T.count = C.count
+            '''
+        )
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['rebuild']:
+        sys.exit(f'usage: python -m {__spec__.name} rebuild')
+
+    try:
+        rebuild()
+    finally:
+        release()
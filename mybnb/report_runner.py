@@ -0,0 +1,103 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Callable, NamedTuple, Optional
+
+from mysql.connector import errorcode
+from mysql.connector.errors import Error as MySQLError
+
+from . import db
+
+MAX_WORKERS = int(os.environ.get('MYBNB_REPORT_WORKERS', 4))
+
+# Seconds from submitting a report until every section must be done. Sections
+# still queued by then are dropped, and the server stops the statements of
+# the ones still running.
+REPORT_TIMEOUT = float(os.environ.get('MYBNB_REPORT_TIMEOUT', 120))
+
+# Shared by all report requests, so concurrent reports can't hold more than
+# MAX_WORKERS pooled connections between them
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='mybnb-report')
+
+class Job(NamedTuple):
+    title: str
+
+    # Returns [(title, records), ...]
+    run: Callable[[], list]
+
+def section(title: str, build: Callable, *args) -> Job:
+    return Job(title, lambda: [(title, build(*args))])
+
+def sections(title: str, build: Callable, *args) -> Job:
+    return Job(title, lambda: build(*args))
+
+def run(jobs: list[Job], timeout: float = REPORT_TIMEOUT,
+        on_progress: Optional[Callable[[int, Optional[float]], None]] = None) -> list[dict]:
+    deadline = time.monotonic() + timeout
+    futures = [_executor.submit(_run_job, job, deadline) for job in jobs]
+
+    # Called from the worker threads as each job finishes, with the job's
+    # index and its time in seconds (None if it raised or was dropped)
+    if on_progress:
+        for (idx, future) in enumerate(futures):
+            future.add_done_callback(
+                lambda future, idx=idx: on_progress(
+                    idx, None if future.cancelled() or future.exception() else future.result()[0]
+                )
+            )
+
+    report = []
+    for job, future in zip(jobs, futures):
+        try:
+            seconds, results = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            # Sections that haven't started don't get to
+            started = not future.cancel()
+            report.append({
+                'title': job.title,
+                'records': [],
+                'seconds': None,
+                'error': (f'Timed out after {timeout:g}s.' if started
+                          else f'Not started within the report\'s {timeout:g}s.')
+            })
+            continue
+        except Exception as e:
+            # One broken section shouldn't take the rest of the report with it
+            timed_out = getattr(e, 'errno', None) == errorcode.ER_QUERY_TIMEOUT
+            report.append({
+                'title': job.title,
+                'records': [],
+                'seconds': None,
+                'error': (f'Timed out after {timeout:g}s.' if timed_out
+                          else f'Failed: {getattr(e, "msg", None) or str(e) or type(e).__name__}')
+            })
+            continue
+
+        # Sections expanded from one job share its timing; show it once
+        for (idx, (title, records)) in enumerate(results):
+            report.append({
+                'title': title,
+                'records': records,
+                'seconds': (seconds if idx == 0 else None)
+            })
+    return report
+
+def _run_job(job: Job, deadline: float):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(job.title)
+
+    started = time.perf_counter()
+    try:
+        # Statements (SELECTs) running past the report's deadline are stopped
+        # by the server, rather than holding on to the worker and connection
+        db.query('SET SESSION max_execution_time = %(ms)s', ms=max(int(remaining * 1000), 1))
+        results = job.run()
+    finally:
+        try:
+            db.query('SET SESSION max_execution_time = 0')
+        except MySQLError:
+            pass
+        # Worker threads outlive the job; don't let them sit on a connection
+        db.release()
+    return time.perf_counter() - started, results
@@ -1,21 +1,42 @@
+from collections import namedtuple
 from typing import NamedTuple, Optional
 from datetime import date
 from flask import session
-import nltk
 
+from . import report_runner, comment_nouns
 from .db import query
 
+class Partitions(dict):
+    def records(self, *key):
+        return self.get(partition_key(key), [])
+
+def partition_key(values):
+    # MySQL groups and compares these columns case-insensitively
+    return tuple(value.casefold() for value in values)
+
+def partition(records, *key_fields):
+    # Splits rows ordered by their leading key columns into per-key sections,
+    # dropping the key columns so each section renders like a per-key query
+    partitions = Partitions()
+    if not records:
+        return partitions
+
+    Record = namedtuple('Record', records[0]._fields[len(key_fields):])
+    for record in records:
+        key = partition_key(record[:len(key_fields)])
+        partitions.setdefault(key, []).append(Record(*record[len(key_fields):]))
+    return partitions
+
 def count_bookings_by_city(start_date: date, end_date: date):
     return query(
         '''
-            SELECT L.city AS City, COUNT(*) AS Count
-            FROM BookingsLive B
-            JOIN Availability A ON A.id = B.availability_id
-            JOIN BookingSlots S ON S.id = A.slot_id
-            JOIN Listings L ON L.id = S.listing_id
+            SELECT L.city AS City, SUM(R.count) AS Count
+            FROM BookingRollups R
+            JOIN Listings L ON L.id = R.listing_id
             WHERE
-                S.date >= %(start_date)s AND
-                S.date <= %(end_date)s
+                NOT R.cancelled AND
+                R.date >= %(start_date)s AND
+                R.date <= %(end_date)s
             GROUP BY L.city
         ''',
         start_date=start_date,
@@ -25,14 +46,13 @@ def count_bookings_by_city(start_date: date, end_date: date):
 def count_bookings_by_city_postal(start_date: date, end_date: date):
     return query(
         '''
-            SELECT L.city AS City, L.postal AS Postal_Code, COUNT(*) AS Count
-            FROM BookingsLive B
-            JOIN Availability A ON A.id = B.availability_id
-            JOIN BookingSlots S ON S.id = A.slot_id
-            JOIN Listings L ON L.id = S.listing_id
+            SELECT L.city AS City, L.postal AS Postal_Code, SUM(R.count) AS Count
+            FROM BookingRollups R
+            JOIN Listings L ON L.id = R.listing_id
             WHERE
-                S.date >= %(start_date)s AND
-                S.date <= %(end_date)s
+                NOT R.cancelled AND
+                R.date >= %(start_date)s AND
+                R.date <= %(end_date)s
             GROUP BY L.city, L.postal
         ''',
         start_date=start_date,
@@ -82,69 +102,64 @@ def all_country_cities():
         '''
     ).fetchall()
 
-def top_hosts_in_country(country):
-    return query(
+def top_hosts_by_country():
+    return partition(query(
         '''
-            SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
+            SELECT L.country AS Country, U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
             FROM Hosts H
             JOIN Users U ON U.id = H.user_id
-            LEFT JOIN Listings L ON L.owner_id = U.id
-            WHERE L.country = %(country)s
-            GROUP BY U.id
-            ORDER BY COUNT(*) DESC
-        ''',
-        country=country
-    ).fetchall()
+            JOIN Listings L ON L.owner_id = U.id
+            GROUP BY L.country, U.id
+            ORDER BY L.country, COUNT(*) DESC
+        '''
+    ).fetchall(), 'Country')
 
-def top_hosts_in_country_city(country, city):
-    return query(
+def top_hosts_by_country_city():
+    return partition(query(
         '''
-            SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
+            SELECT L.country AS Country, L.city AS City, U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
             FROM Hosts H
             JOIN Users U ON U.id = H.user_id
-            LEFT JOIN Listings L ON L.owner_id = U.id
-            WHERE L.country = %(country)s AND L.city = %(city)s
-            GROUP BY U.id
-            ORDER BY COUNT(*) DESC
-        ''',
-        country=country,
-        city=city
-    ).fetchall()
+            JOIN Listings L ON L.owner_id = U.id
+            GROUP BY L.country, L.city, U.id
+            ORDER BY L.country, L.city, COUNT(*) DESC
+        '''
+    ).fetchall(), 'Country', 'City')
 
-def potential_commercial_hosts(country, city):
-    return query(
+def potential_commercial_hosts_by_country_city():
+    return partition(query(
         '''
-            SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
-            FROM Hosts H
-            JOIN Users U ON U.id = H.user_id
-            LEFT JOIN Listings L ON L.owner_id = U.id
-            WHERE L.country = %(country)s AND L.city = %(city)s
-            GROUP BY U.id
-            HAVING COUNT(*) >= 0.10 * (
-                SELECT COUNT(*)
-                FROM Listings
-                WHERE country = %(country)s AND city = %(city)s
+            WITH HostListings AS (
+                SELECT
+                    L.country AS Country, L.city AS City,
+                    U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count,
+                    SUM(COUNT(*)) OVER (PARTITION BY L.country, L.city) AS City_Count
+                FROM Hosts H
+                JOIN Users U ON U.id = H.user_id
+                JOIN Listings L ON L.owner_id = U.id
+                GROUP BY L.country, L.city, U.id
             )
-        ''',
-        country=country,
-        city=city
-    ).fetchall()
+            SELECT Country, City, User_ID, Name, Username, Count
+            FROM HostListings
+            WHERE Count >= 0.10 * City_Count
+            ORDER BY Country, City
+        '''
+    ).fetchall(), 'Country', 'City')
 
 def top_renters(start_date: date, end_date: date):
     return query(
         '''
             WITH TopRenters AS (
-                SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
+                SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, SUM(B.count) AS Count
                 FROM Renters R
                 JOIN Users U ON U.id = R.user_id
-                JOIN BookingsLive B ON B.renter_id = U.id
-                JOIN Availability A ON A.id = B.availability_id
-                JOIN BookingSlots S ON S.id = A.slot_id
+                JOIN BookingRollups B ON B.renter_id = U.id
                 WHERE
-                    S.date >= %(start_date)s AND
-                    S.date <= %(end_date)s
+                    NOT B.cancelled AND
+                    B.date >= %(start_date)s AND
+                    B.date <= %(end_date)s
                 GROUP BY U.id
-                ORDER BY COUNT(*) DESC
+                ORDER BY SUM(B.count) DESC
             )
             SELECT * FROM TopRenters
                 UNION
@@ -157,45 +172,39 @@ def top_renters(start_date: date, end_date: date):
         end_date=end_date
     ).fetchall()
 
-def top_renters_by_country_city(start_date: date, end_date: date, country, city):
-    return query(
+def top_renters_by_country_city(start_date: date, end_date: date):
+    return partition(query(
         '''
-            SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
+            SELECT L.country AS Country, L.city AS City, U.id AS User_ID, U.name AS Name, U.username AS Username, SUM(B.count) AS Count
             FROM Renters R
             JOIN Users U ON U.id = R.user_id
-            JOIN BookingsLive B ON B.renter_id = U.id
-            JOIN Availability A ON A.id = B.availability_id
-            JOIN BookingSlots S ON S.id = A.slot_id
-            JOIN Listings L ON L.id = S.listing_id
+            JOIN BookingRollups B ON B.renter_id = U.id
+            JOIN Listings L ON L.id = B.listing_id
             WHERE
-                S.date >= %(start_date)s AND
-                S.date <= %(end_date)s AND
-                L.country = %(country)s AND
-                L.city = %(city)s
-            GROUP BY U.id
-            HAVING COUNT(*) >= 2
-            ORDER BY COUNT(*) DESC
+                NOT B.cancelled AND
+                B.date >= %(start_date)s AND
+                B.date <= %(end_date)s
+            GROUP BY L.country, L.city, U.id
+            HAVING SUM(B.count) >= 2
+            ORDER BY L.country, L.city, SUM(B.count) DESC
         ''',
         start_date=start_date,
-        end_date=end_date,
-        country=country,
-        city=city
-    ).fetchall()
+        end_date=end_date
+    ).fetchall(), 'Country', 'City')
 
 def top_cancelling_renters(start_date, end_date):
     return query(
         '''
-            SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
+            SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, SUM(B.count) AS Count
             FROM Renters R
             JOIN Users U ON U.id = R.user_id
-            JOIN BookingsCancelled B ON B.renter_id = U.id
-            JOIN Availability A ON A.id = B.availability_id
-            JOIN BookingSlots S ON S.id = A.slot_id
+            JOIN BookingRollups B ON B.renter_id = U.id
             WHERE
-                S.date >= %(start_date)s AND
-                S.date <= %(end_date)s
+                B.cancelled AND
+                B.date >= %(start_date)s AND
+                B.date <= %(end_date)s
             GROUP BY U.id
-            ORDER BY COUNT(*) DESC
+            ORDER BY SUM(B.count) DESC
         ''',
         start_date=start_date,
         end_date=end_date
@@ -204,57 +213,87 @@ def top_cancelling_renters(start_date, end_date):
 def top_cancelling_hosts(start_date, end_date):
     return query(
         '''
-            SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, COUNT(*) AS Count
+            SELECT U.id AS User_ID, U.name AS Name, U.username AS Username, SUM(B.count) AS Count
             FROM Hosts H
             JOIN Users U ON U.id = H.user_id
             JOIN Listings L ON L.owner_id = U.id
-            JOIN BookingSlots S ON S.listing_id = L.id
-            JOIN Availability A ON A.slot_id = S.id
-            JOIN BookingsCancelled B ON B.availability_id = A.id
+            JOIN BookingRollups B ON B.listing_id = L.id
             WHERE
-                S.date >= %(start_date)s AND
-                S.date <= %(end_date)s
+                B.cancelled AND
+                B.date >= %(start_date)s AND
+                B.date <= %(end_date)s
             GROUP BY U.id
-            ORDER BY COUNT(*) DESC
+            ORDER BY SUM(B.count) DESC
         ''',
         start_date=start_date,
         end_date=end_date
     ).fetchall()
 
 def top_noun_phrases_by_listing_comment():
-    comments = query(
+    comment_nouns.refresh()
+
+    return query(
         '''
-            SELECT R.name AS Renter_Name, L.address AS Listing_Address, LC.comment AS NPs, LC.rating AS Rating
+            SELECT R.name AS Renter_Name, L.address AS Listing_Address, N.nouns AS NPs, LC.rating AS Rating
             FROM ListingComments LC
+            JOIN ListingCommentNouns N ON N.renter_id = LC.renter_id AND N.listing_id = LC.listing_id
             JOIN Users R ON R.id = LC.renter_id
             JOIN Listings L ON L.id = LC.listing_id
             WHERE LC.comment IS NOT NULL
         '''
     ).fetchall()
 
-    def find_noun_phrases(text: str):
-        tokens = nltk.word_tokenize(text)
-        return [word for (word, tag) in nltk.pos_tag(tokens) if tag.startswith('N')]
+def top_noun_phrases_in_listing_comments():
+    comment_nouns.refresh()
 
-    return [
-        comment._replace(NPs=', '.join(find_noun_phrases(comment.NPs)))
-        for comment in comments
-    ]
+    return query(
+        '''
+            SELECT noun AS NP, count AS Count
+            FROM ListingCommentNounCounts
+            ORDER BY count DESC, noun
+        '''
+    ).fetchall()
 
-def top_noun_phrases_in_listing_comments():
-    top_nps = {}
+def report_jobs(start_date: date, end_date: date):
+    country_cities = all_country_cities()
 
-    for comment in top_noun_phrases_by_listing_comment():
-        for np in comment.NPs.split(', '):
-            top_nps.setdefault(np, 0)
-            top_nps[np] += 1
+    def per_country(title_format, build, *args):
+        def run():
+            partitions = build(*args)
+            return [
+                (title_format.format(country=country), partitions.records(country))
+                for country, in all_countries()
+            ]
+        return report_runner.sections(title_format.format(country='Each Country'), run)
 
-    class TopNP(NamedTuple):
-        NP: str
-        Count: str
+    def per_country_city(title_format, build, *args):
+        def run():
+            partitions = build(*args)
+            return [
+                (title_format.format(country=country, city=city), partitions.records(country, city))
+                for country, city in country_cities
+            ]
+        return report_runner.sections(title_format.format(country='Each Country', city='Each City'), run)
 
     return [
-        TopNP(NP=np, Count=count)
-        for (np, count) in sorted(top_nps.items(), key=lambda item: item[1], reverse=True)
-        if np
+        report_runner.section('Bookings by City', count_bookings_by_city, start_date, end_date),
+        report_runner.section('Bookings by City and Postal Code', count_bookings_by_city_postal, start_date, end_date),
+
+        report_runner.section('Listings by Country', count_listings_by_country),
+        report_runner.section('Listings by Country and City', count_listings_by_country_city),
+        report_runner.section('Listings by Country, City, and Postal Code', count_listings_by_country_city_postal),
+
+        per_country('Top Hosts in {country}', top_hosts_by_country),
+        per_country_city('Top Hosts in {city}, {country}', top_hosts_by_country_city),
+
+        per_country_city('Potential Commercial Hosts in {city}, {country}', potential_commercial_hosts_by_country_city),
+
+        report_runner.section('Top Renters by Bookings', top_renters, start_date, end_date),
+        per_country_city('Top Renters in {city}, {country} by Bookings (≥2)', top_renters_by_country_city, start_date, end_date),
+
+        report_runner.section('Top Hosts by Cancellations', top_cancelling_hosts, start_date, end_date),
+        report_runner.section('Top Renters by Cancellations', top_cancelling_renters, start_date, end_date),
+
+        report_runner.section('Top Noun Phrases by Listing Comment', top_noun_phrases_by_listing_comment),
+        report_runner.section('Top Noun Phrases in All Listing Comments', top_noun_phrases_in_listing_comments),
     ]
@@ -0,0 +1,418 @@
+import datetime
+import os
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from . import amenities, search_order
+from .db import query, untracked_query
+from .geo import KM_PER_DEGREE, bounding_box
+
+# Optional in-process index of open availability for the /listings search,
+# answering the same filters as tables.listings.search with NumPy column
+# arrays instead of a query. It needs the search-index extra (numpy), which
+# is imported on first use only.
+#
+# Every process that has the index enabled loads it on its first search and
+# then catches up with writes through SearchIndexChanges, a log of listings
+# whose open availability changed, which the write paths append to in the
+# same transaction as the change. Listings found in the log are reloaded
+# whole. The log is read by time rather than by id, since ids are handed out
+# before the writing transactions commit, in any order; a transaction taking
+# longer than CHANGE_GRACE seconds to commit could be missed until the next
+# full reload.
+ENABLED = bool(os.environ.get('MYBNB_SEARCH_INDEX'))
+
+# Seconds between full reloads; changes are kept for twice as long
+MAX_AGE = float(os.environ.get('MYBNB_SEARCH_INDEX_MAX_AGE', 3600))
+CHANGE_GRACE = 30
+
+class Result(NamedTuple):
+    # Same fields as the rows of tables.listings.search
+    rental_price: float
+    country: str
+    city: str
+    postal: str
+    address: str
+    lat: float
+    lon: float
+    type: str
+    amenities: str
+    listing_id: int
+    slot_id: int
+    availability_id: int
+    date: datetime.date
+    distance: Optional[float]
+
+class ListingResult(NamedTuple):
+    # Same fields as the rows of tables.listings.search_grouped
+    listing_id: int
+    country: str
+    city: str
+    postal: str
+    address: str
+    lat: float
+    lon: float
+    type: str
+    amenities: str
+    distance: Optional[float]
+    min_price: float
+    max_price: float
+    total_price: float
+    nights: int
+    every_night: bool
+
+class Snapshot(NamedTuple):
+    # One entry per open night; listing attributes are repeated per night so
+    # that every filter is a single mask over these arrays
+    columns: dict
+
+    # Listing rows by id, for the results
+    listings: dict
+
+    loaded_at: float
+
+    # Database time of the last catch-up, and when each change applied since
+    # CHANGE_GRACE seconds before it was made, by change id
+    caught_up_at: datetime.datetime
+    applied_changes: dict
+
+# Case-insensitive codes for the values compared with '=' (MySQL compares
+# them under a case-insensitive collation); only ever added to
+_codes = {'type': {}, 'postal': {}, 'address': {}}
+
+# Guards the snapshot and catch-ups; full reloads are taken one at a time
+# under _reload_lock, outside of it
+_lock = threading.Lock()
+_reload_lock = threading.Lock()
+_snapshot: Optional[Snapshot] = None
+
+def record_slots(slot_ids_sql: str, **env):
+    if not ENABLED:
+        return
+    query(
+        f'''
+            INSERT INTO SearchIndexChanges(listing_id)
+            SELECT DISTINCT listing_id
+            FROM BookingSlots
+            WHERE id IN ({slot_ids_sql})
+        ''',
+        **env
+    )
+
+def record_listings(listing_ids_sql: str, **env):
+    if not ENABLED:
+        return
+    query(
+        f'''
+            INSERT INTO SearchIndexChanges(listing_id)
+            SELECT id
+            FROM Listings
+            WHERE id IN ({listing_ids_sql})
+        ''',
+        **env
+    )
+
+def current() -> Snapshot:
+    global _snapshot
+
+    with _lock:
+        # While one thread reloads, the others keep catching up the old
+        # snapshot rather than wait for the new one
+        if _snapshot is not None and (time.time() - _snapshot.loaded_at <= MAX_AGE or _reload_lock.locked()):
+            _snapshot = catch_up(_snapshot)
+            return _snapshot
+
+    with _reload_lock:
+        with _lock:
+            due = _snapshot is None or time.time() - _snapshot.loaded_at > MAX_AGE
+        loaded = load() if due else None
+
+        with _lock:
+            # Changes made during the load are applied on the swap
+            _snapshot = catch_up(loaded or _snapshot)
+            return _snapshot
+
+def load() -> Snapshot:
+    now = query('SELECT NOW() AS now').fetchone().now
+    # Housekeeping of the log; not a change to anything searched
+    untracked_query(
+        '''
+            DELETE FROM SearchIndexChanges
+            WHERE changed_at < NOW() - INTERVAL %(retention)s SECOND
+        ''',
+        retention=int(2 * MAX_AGE)
+    )
+
+    nights = _open_nights()
+    listings = {listing.id: listing for listing in query('SELECT * FROM Listings')}
+    return Snapshot(
+        columns=_columns(listings, nights),
+        listings=listings,
+        loaded_at=time.time(),
+        caught_up_at=now,
+        applied_changes={}
+    )
+
+def catch_up(snapshot: Snapshot) -> Snapshot:
+    import numpy as np
+
+    now = query('SELECT NOW() AS now').fetchone().now
+    changes = [
+        change
+        for change in query(
+            '''
+                SELECT id, listing_id, changed_at
+                FROM SearchIndexChanges
+                WHERE changed_at >= %(since)s
+            ''',
+            since=snapshot.caught_up_at - datetime.timedelta(seconds=CHANGE_GRACE)
+        )
+        if change.id not in snapshot.applied_changes
+    ]
+    if not changes:
+        return snapshot._replace(caught_up_at=now)
+
+    changed_ids = sorted({change.listing_id for change in changes})
+    listing_ids_sql = ', '.join(f'%(listing_id_{idx})s' for idx in range(len(changed_ids)))
+    listing_ids_env = {f'listing_id_{idx}': listing_id for (idx, listing_id) in enumerate(changed_ids)}
+
+    listings = dict(snapshot.listings)
+    for listing_id in changed_ids:
+        listings.pop(listing_id, None)
+    nights = _open_nights(f'L.id IN ({listing_ids_sql})', **listing_ids_env)
+    listings.update(
+        (listing.id, listing)
+        for listing in query(f'SELECT * FROM Listings WHERE id IN ({listing_ids_sql})', **listing_ids_env)
+    )
+
+    kept = ~np.isin(snapshot.columns['listing_id'], changed_ids)
+    reloaded = _columns(listings, nights)
+    since = now - datetime.timedelta(seconds=CHANGE_GRACE)
+    return snapshot._replace(
+        columns={
+            name: np.concatenate([column[kept], reloaded[name]])
+            for (name, column) in snapshot.columns.items()
+        },
+        listings=listings,
+        caught_up_at=now,
+        applied_changes={
+            id: changed_at
+            for (id, changed_at) in [*snapshot.applied_changes.items(), *((change.id, change.changed_at) for change in changes)]
+            if changed_at >= since
+        }
+    )
+
+def _open_nights(condition_sql: str = 'TRUE', **env):
+    # Same nights as tables.listings.search
+    return query(
+        f'''
+            SELECT A.id AS availability_id, S.id AS slot_id, S.listing_id, S.date, A.rental_price
+            FROM Listings L
+            JOIN BookingSlots S ON S.listing_id = L.id
+            JOIN AvailabilityLive A ON A.slot_id = S.id
+            WHERE {condition_sql}
+            AND NOT EXISTS ( SELECT availability_id FROM Bookings WHERE Bookings.availability_id = A.id AND Bookings.cancelled = 0)
+        ''',
+        **env
+    ).fetchall()
+
+def _code(kind: str, value: str) -> int:
+    return _codes[kind].setdefault(value.casefold(), len(_codes[kind]))
+
+def _columns(listings: dict, nights) -> dict:
+    import numpy as np
+
+    # Nights of listings deleted while loading are dropped
+    nights = [night for night in nights if night.listing_id in listings]
+    night_listings = [listings[night.listing_id] for night in nights]
+    return {
+        'availability_id': np.array([night.availability_id for night in nights], dtype=np.int64),
+        'slot_id': np.array([night.slot_id for night in nights], dtype=np.int64),
+        'listing_id': np.array([night.listing_id for night in nights], dtype=np.int64),
+        'date': np.array([night.date.toordinal() for night in nights], dtype=np.int32),
+        'rental_price': np.array([night.rental_price for night in nights], dtype=np.float64),
+
+        'owner_id': np.array([listing.owner_id for listing in night_listings], dtype=np.int64),
+        'lat': np.array([listing.lat for listing in night_listings], dtype=np.float64),
+        'lon': np.array([listing.lon for listing in night_listings], dtype=np.float64),
+        'type': np.array([_code('type', listing.type) for listing in night_listings], dtype=np.int32),
+        'postal': np.array([_code('postal', listing.postal[:3]) for listing in night_listings], dtype=np.int32),
+        'address': np.array([_code('address', listing.address) for listing in night_listings], dtype=np.int32),
+        'amenity_bits': np.array([listing.amenity_bits for listing in night_listings], dtype=np.uint64),
+    }
+
+def search(id, filters, after: Optional[str] = None, limit: Optional[int] = None) -> search_order.SearchPage:
+    # Takes the same arguments as tables.listings.search
+    snapshot = current()
+    (selected, distance) = _matching(snapshot.columns, id, filters)
+
+    keys = search_order.sort_keys(filters)
+    key_columns = {
+        key.column: distance[selected] if key.column == 'distance' else snapshot.columns[key.column][selected]
+        for key in keys
+    }
+    (page, limit) = _page(keys, key_columns, after, limit)
+    rows = [
+        _result(snapshot, idx, None if distance is None else float(distance[idx]))
+        for idx in selected[page].tolist()
+    ]
+    return search_order.page(rows, keys, limit)
+
+def search_grouped(id, filters, after: Optional[str] = None, limit: Optional[int] = None) -> search_order.SearchPage:
+    # Takes the same arguments as tables.listings.search_grouped
+    import numpy as np
+
+    snapshot = current()
+    (selected, distance) = _matching(snapshot.columns, id, filters)
+    if not len(selected):
+        return search_order.SearchPage([], None)
+
+    # Matching nights by listing, then summed up over each listing's run
+    selected = selected[np.argsort(snapshot.columns['listing_id'][selected], kind='stable')]
+    night_listing_ids = snapshot.columns['listing_id'][selected]
+    starts = np.flatnonzero(np.r_[True, night_listing_ids[1:] != night_listing_ids[:-1]])
+    prices = snapshot.columns['rental_price'][selected]
+    groups = {
+        'listing_id': night_listing_ids[starts],
+        'min_price': np.minimum.reduceat(prices, starts),
+        'max_price': np.maximum.reduceat(prices, starts),
+        'total_price': np.add.reduceat(prices, starts),
+        'nights': np.diff(np.r_[starts, len(selected)]),
+    }
+    if distance is not None:
+        # Every night of a listing is equally far
+        groups['distance'] = distance[selected][starts]
+
+    keys = search_order.grouped_sort_keys(filters)
+    (page, limit) = _page(keys, {key.column: groups[key.column] for key in keys}, after, limit)
+    rows = [
+        _listing_result(
+            snapshot.listings[int(groups['listing_id'][idx])],
+            {name: column[idx].item() for (name, column) in groups.items()},
+            search_order.window_nights(filters)
+        )
+        for idx in page.tolist()
+    ]
+    return search_order.page(rows, keys, limit)
+
+def _matching(columns: dict, id, filters):
+    # Indices of the nights matching the filters, and the distances of all
+    # nights in the search box (None without a distance filter)
+    import numpy as np
+
+    compare = {'<=': np.less_equal, '>=': np.greater_equal, '=': np.equal}
+
+    mask = columns['owner_id'] != id
+    distance = None
+    nearest = None
+    for (filter_name, filter_value, filter_sign) in filters:
+        if filter_name == 'rental_price':
+            mask &= compare[filter_sign](columns['rental_price'], filter_value)
+        elif filter_name == 'date':
+            mask &= compare[filter_sign](columns['date'], datetime.date.fromisoformat(filter_value).toordinal())
+        elif filter_name in ('postal', 'address') or (filter_name == 'type' and filter_value != 'None'):
+            mask &= columns[filter_name] == _codes[filter_name].get(filter_value.casefold(), -1)
+        elif filter_name == 'amenities':
+            bits = np.uint64(amenities.bitmask(filter_value))
+            mask &= (columns['amenity_bits'] & bits) == bits
+        elif filter_name == 'stay':
+            (start, end) = (datetime.date.fromisoformat(value).toordinal() for value in filter_value)
+            in_stay = (columns['date'] >= start) & (columns['date'] <= end)
+            (listing_ids, nights) = np.unique(columns['listing_id'][in_stay], return_counts=True)
+            mask &= np.isin(columns['listing_id'], listing_ids[nights == end - start + 1])
+        elif filter_name == 'nearest':
+            nearest = filter_value
+        elif filter_name == 'distance':
+            (lat, lon, max_distance) = filter_value
+            (lat_range, lon_range) = bounding_box(lat, lon, max_distance)
+            mask &= (columns['lat'] >= lat_range[0]) & (columns['lat'] <= lat_range[1])
+            if lon_range:
+                mask &= (columns['lon'] >= lon_range[0]) & (columns['lon'] <= lon_range[1])
+
+            # Exact distances of the nights left in the box only
+            distance = np.full(len(mask), np.nan)
+            in_box = np.flatnonzero(mask)
+            (night_lat, night_lon) = (np.radians(columns['lat'][in_box]), np.radians(columns['lon'][in_box]))
+            distance[in_box] = KM_PER_DEGREE * np.degrees(np.arccos(np.minimum(
+                1.0,
+                np.cos(night_lat) * np.cos(np.radians(lat)) * np.cos(night_lon - np.radians(lon))
+                + np.sin(night_lat) * np.sin(np.radians(lat))
+            )))
+            mask[in_box] &= distance[in_box] <= max_distance
+        elif filter_name not in ('type', 'sort'):
+            raise ValueError(f'Unsupported filter {filter_name!r}.')
+
+    selected = np.flatnonzero(mask)
+
+    if nearest and distance is not None:
+        (listing_ids, first) = np.unique(columns['listing_id'][selected], return_index=True)
+        nearest_ids = listing_ids[np.lexsort((listing_ids, distance[selected][first]))[:nearest]]
+        selected = selected[np.isin(columns['listing_id'][selected], nearest_ids)]
+
+    return selected, distance
+
+def _page(keys: list, key_columns: dict, after: Optional[str], limit: Optional[int]):
+    # Positions in key_columns of one page plus one row, in the same order as
+    # the query, starting after the cursor; and the page size
+    import numpy as np
+
+    limit = search_order.page_size(limit)
+    positions = np.arange(len(key_columns[keys[-1].column]))
+    columns = [key_columns[key.column] for key in keys]
+
+    cursor = search_order.decode_cursor(after, keys)
+    if cursor:
+        is_after = np.zeros(len(positions), dtype=bool)
+        is_equal = np.ones(len(positions), dtype=bool)
+        for (key, column, value) in zip(keys, columns, cursor):
+            if key.column == 'date':
+                value = value.toordinal()
+            is_after |= is_equal & ((column < value) if key.descending else (column > value))
+            is_equal &= column == value
+        (positions, columns) = (positions[is_after], [column[is_after] for column in columns])
+
+    order = np.lexsort([
+        -column if key.descending else column
+        for (key, column) in reversed(list(zip(keys, columns)))
+    ])
+    return positions[order[:limit + 1]], limit
+
+def _result(snapshot: Snapshot, idx: int, distance: Optional[float]) -> Result:
+    columns = snapshot.columns
+    listing = snapshot.listings[int(columns['listing_id'][idx])]
+    return Result(
+        rental_price=float(columns['rental_price'][idx]),
+        country=listing.country,
+        city=listing.city,
+        postal=listing.postal,
+        address=listing.address,
+        lat=listing.lat,
+        lon=listing.lon,
+        type=listing.type,
+        amenities=listing.amenities,
+        listing_id=listing.id,
+        slot_id=int(columns['slot_id'][idx]),
+        availability_id=int(columns['availability_id'][idx]),
+        date=datetime.date.fromordinal(int(columns['date'][idx])),
+        distance=distance
+    )
+
+def _listing_result(listing, group: dict, window_nights: Optional[int]) -> ListingResult:
+    return ListingResult(
+        listing_id=listing.id,
+        country=listing.country,
+        city=listing.city,
+        postal=listing.postal,
+        address=listing.address,
+        lat=listing.lat,
+        lon=listing.lon,
+        type=listing.type,
+        amenities=listing.amenities,
+        distance=group.get('distance'),
+        min_price=group['min_price'],
+        max_price=group['max_price'],
+        total_price=group['total_price'],
+        nights=group['nights'],
+        every_night=group['nights'] == window_nights
+    )
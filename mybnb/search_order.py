@@ -0,0 +1,110 @@
+import base64
+import json
+import os
+from datetime import date
+from typing import NamedTuple, Optional
+
+# Listing search results come in pages ordered by sort_keys(), and the next
+# page starts after the last row of the previous one (keyset pagination), so
+# every page costs the same however deep it is
+
+PAGE_SIZE = int(os.environ.get('MYBNB_SEARCH_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = 500
+
+class SortKey(NamedTuple):
+    # A column of the search results
+    column: str
+    descending: bool = False
+
+class SearchPage(NamedTuple):
+    rows: list
+
+    # Cursor of the following page, or None on the last page
+    after: Optional[str]
+
+def sort_keys(filters) -> list[SortKey]:
+    # Price if chosen, then nearest first if searching by distance, then date;
+    # the availability id makes every row's key unique
+    keys = []
+    for (filter_name, filter_value, _) in filters:
+        if filter_name == 'sort' and filter_value in ('Low To High', 'High To Low'):
+            keys.append(SortKey('rental_price', descending=(filter_value == 'High To Low')))
+    if any(filter_name == 'distance' for (filter_name, _, _) in filters):
+        keys.append(SortKey('distance'))
+    return [*keys, SortKey('date'), SortKey('availability_id')]
+
+def grouped_sort_keys(filters) -> list[SortKey]:
+    # Same for one row per listing, by its cheapest matching night
+    keys = []
+    for (filter_name, filter_value, _) in filters:
+        if filter_name == 'sort' and filter_value in ('Low To High', 'High To Low'):
+            keys.append(SortKey('min_price', descending=(filter_value == 'High To Low')))
+    if any(filter_name == 'distance' for (filter_name, _, _) in filters):
+        keys.append(SortKey('distance'))
+    return [*keys, SortKey('listing_id')]
+
+def window_nights(filters) -> Optional[int]:
+    # Number of nights in the date range searched for, if it has both ends
+    starts = [date.fromisoformat(value) for (name, value, sign) in filters if name == 'date' and sign == '>=']
+    ends = [date.fromisoformat(value) for (name, value, sign) in filters if name == 'date' and sign == '<=']
+    if not (starts and ends):
+        return None
+    return max((min(ends) - max(starts)).days + 1, 0)
+
+def page_size(limit: Optional[int]) -> int:
+    return min(limit or PAGE_SIZE, MAX_PAGE_SIZE)
+
+def encode_cursor(row, keys: list[SortKey]) -> str:
+    values = [getattr(row, key.column) for key in keys]
+    cursor = {
+        'keys': [key.column for key in keys],
+        'values': [value.isoformat() if isinstance(value, date) else value for value in values],
+    }
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+def decode_cursor(after: Optional[str], keys: list[SortKey]) -> Optional[list]:
+    # None for the first page, including when the cursor is malformed or was
+    # made for a different order (the filters were changed in between)
+    if not after:
+        return None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(after.encode()))
+    except ValueError:
+        return None
+    if not isinstance(cursor, dict) or cursor.get('keys') != [key.column for key in keys]:
+        return None
+
+    # One scalar per key, or keyset_sql() would refer to missing parameters
+    values = cursor.get('values')
+    if not (isinstance(values, list) and len(values) == len(keys)):
+        return None
+    if not all(isinstance(value, (str, int, float)) and not isinstance(value, bool) for value in values):
+        return None
+    try:
+        return [
+            date.fromisoformat(value) if key.column == 'date' else value
+            for (key, value) in zip(keys, values)
+        ]
+    except (TypeError, ValueError):
+        return None
+
+def keyset_sql(keys: list[SortKey], cursor: list) -> tuple[str, dict]:
+    # Rows after the cursor in the order of keys:
+    # (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...
+    clauses = []
+    for (idx, key) in enumerate(keys):
+        comparison = '<' if key.descending else '>'
+        conditions = [
+            *(f'{previous.column} = %(after_{previous_idx})s' for (previous_idx, previous) in enumerate(keys[:idx])),
+            f'{key.column} {comparison} %(after_{idx})s'
+        ]
+        clauses.append(f"({' AND '.join(conditions)})")
+    return ' OR '.join(clauses), {f'after_{idx}': value for (idx, value) in enumerate(cursor)}
+
+def page(rows: list, keys: list[SortKey], limit: int) -> SearchPage:
+    # rows holds up to limit + 1 rows, the extra one telling that there is a
+    # next page
+    rows = rows[:limit + 1]
+    if len(rows) <= limit:
+        return SearchPage(rows, None)
+    return SearchPage(rows[:limit], encode_cursor(rows[limit - 1], keys))
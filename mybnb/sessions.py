@@ -0,0 +1,149 @@
+import os
+import secrets
+import threading
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app, session as current_session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from . import db
+
+# Where sessions (the logged-in user id, its renter and host flags, flashes
+# and CSRF tokens) are kept, set with MYBNB_SESSION_STORE:
+#
+#   filesystem  flask-session's files in ./flask_session, one per session;
+#               local to one host (the default)
+#   cookie      Flask's signed cookie, so there is nothing to store or share;
+#               needs MYBNB_SECRET_KEY, as the user id is only as safe as the
+#               key that signs it
+#   database    the Sessions table, shared by every worker on every host;
+#               only sessions that changed are written back
+STORES = ('filesystem', 'cookie', 'database')
+STORE = os.environ.get('MYBNB_SESSION_STORE', 'filesystem')
+
+# Expired rows are deleted when this many new database sessions were made
+PRUNE_EVERY = 100
+
+def init_app(app, store: str = STORE):
+    if store not in STORES:
+        raise ValueError(f'Unknown session store {store!r}; choose one of {", ".join(STORES)}.')
+
+    if store == 'filesystem':
+        # Imported here, as the other stores don't need it
+        from flask_session import Session
+
+        app.config['SESSION_TYPE'] = 'filesystem'
+        Session(app)
+    elif store == 'cookie':
+        if not os.environ.get('MYBNB_SECRET_KEY'):
+            raise RuntimeError('The cookie session store needs MYBNB_SECRET_KEY to be set.')
+    else:
+        app.session_interface = DatabaseSessionInterface()
+
+def rotate_id():
+    # Called on logging in. Server-side sessions get a new id, so that an id
+    # planted in the browser beforehand (session fixation) doesn't end up
+    # logged in too; signed cookies carry no id to plant.
+    if isinstance(current_session, DatabaseSession):
+        current_session.rotate_id()
+    elif hasattr(current_session, 'sid'):
+        # flask-session's files
+        interface = current_app.session_interface
+        interface.cache.delete(interface.key_prefix + current_session.sid)
+        current_session.sid = secrets.token_urlsafe(32)
+        current_session.modified = True
+
+class DatabaseSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid: str = None, new: bool = False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Deleted when the session is saved under its new id
+        self.previous_sid = None
+
+    def rotate_id(self):
+        if not self.new:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+class DatabaseSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self):
+        # Shared by every thread serving requests
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def open_session(self, app, request) -> DatabaseSession:
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            row = db.query(
+                '''
+                    SELECT data
+                    FROM Sessions
+                    WHERE id = %(id)s AND expires_at > UTC_TIMESTAMP()
+                ''',
+                id=sid
+            ).fetchone()
+            if row:
+                return DatabaseSession(self.serializer.loads(row.data), sid=sid)
+
+        return DatabaseSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session: DatabaseSession, response):
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid:
+            db.untracked_query('DELETE FROM Sessions WHERE id = %(id)s', id=session.previous_sid)
+            session.previous_sid = None
+
+        # Emptied sessions go away, along with their cookie
+        if not session:
+            if session.modified and not session.new:
+                db.untracked_query('DELETE FROM Sessions WHERE id = %(id)s', id=session.sid)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+
+        if not session.modified:
+            return
+
+        expires = self.get_expiration_time(app, session)
+        db.untracked_query(
+            '''
+                REPLACE INTO Sessions(id, data, expires_at)
+                VALUES (%(id)s, %(data)s, %(expires_at)s)
+            ''',
+            id=session.sid,
+            data=self.serializer.dumps(dict(session)),
+            expires_at=(expires or datetime.now(timezone.utc) + app.permanent_session_lifetime).replace(tzinfo=None)
+        )
+        if session.new:
+            self._prune()
+
+        response.set_cookie(
+            cookie_name,
+            session.sid,
+            expires=expires,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+    def _prune(self):
+        with self._lock:
+            self._created += 1
+            due = self._created % PRUNE_EVERY == 0
+        if due:
+            db.untracked_query('DELETE FROM Sessions WHERE expires_at < UTC_TIMESTAMP()')
@@ -1,10 +1,13 @@
-from typing import NamedTuple, Optional
-from datetime import date
+import itertools
+from contextlib import contextmanager
+from typing import Iterable, NamedTuple, Optional
+from datetime import date, timedelta
 from flask import session
 from wtforms.validators import ValidationError
 
 from . import bookings, listings
-from ..db import query
+from .. import price_stats, booking_rollups, search_index, listing_calendars
+from ..db import query, transaction, temporary_table
 
 class BookingSlot(NamedTuple):
     id: int
@@ -84,7 +87,7 @@ def for_id(id) -> BookingSlot:
         id=id
     ).fetchone()
 
-    return BookingSlot.from_record(slot)
+    return BookingSlot.from_record(slot) if slot else None
 
 def add(**env):
     query(
@@ -95,37 +98,242 @@ def add(**env):
         **env
     )
 
-def update(**env):
-    query(
-        '''
-            UPDATE Availability
-            SET
-                retracted = 1
-            WHERE slot_id = %(id)s
-        ''',
-        **env
+# Rows per INSERT statement when adding slots in bulk, to stay well within
+# max_allowed_packet
+ADD_MANY_BATCH_SIZE = 5000
+
+def add_many(slots: Iterable[tuple[int, date]]) -> int:
+    # Read a batch at a time, so large ranges are never built up in memory
+    slots = iter(slots)
+    added = 0
+
+    with transaction():
+        while batch := list(itertools.islice(slots, ADD_MANY_BATCH_SIZE)):
+            added += query(
+                f'''
+                    INSERT IGNORE INTO BookingSlots(listing_id, date)
+                    VALUES {', '.join(f'(%(listing_id_{idx})s, %(date_{idx})s)' for idx in range(len(batch)))}
+                ''',
+                **{f'listing_id_{idx}': listing_id for (idx, (listing_id, _)) in enumerate(batch)},
+                **{f'date_{idx}': date for (idx, (_, date)) in enumerate(batch)}
+            ).rowcount
+
+    # Slots that already existed are left alone and not counted
+    return added
+
+def add_ranges(ranges: Iterable[tuple[int, date, date]]) -> int:
+    return add_many(
+        (listing_id, start_date + timedelta(days=day_offset))
+        for (listing_id, start_date, end_date) in ranges
+        for day_offset in range(0, (end_date - start_date).days + 1)
     )
 
-    if 'rental_price' in env:
+# Most days a host can add to a listing's schedule at once; as far ahead as
+# the availability calendars look
+MAX_RANGE_DAYS = listing_calendars.HORIZON_DAYS
+
+def add_range(listing_id, start_date: date, end_date: date) -> int:
+    if end_date < start_date:
+        raise ValidationError('The end date cannot be before the start date.')
+    if (end_date - start_date).days >= MAX_RANGE_DAYS:
+        raise ValidationError(f'At most {MAX_RANGE_DAYS} days can be added at once.')
+
+    return add_ranges([(listing_id, start_date, end_date)])
+
+class PricingRule(NamedTuple):
+    # Prices for Sunday to Thursday nights and for Friday and Saturday
+    # nights; nights whose price is None are left alone
+    weekday_price: Optional[float] = None
+    weekend_price: Optional[float] = None
+
+    # Percentage applied to the current price of open nights instead, e.g.
+    # -10 for a 10% discount
+    percent_change: Optional[float] = None
+
+def set_prices(listing_ids: list, start_date: date, end_date: date, rule: PricingRule) -> int:
+    # Reprices every unbooked future night of the current user's listings in
+    # the range with a fixed number of statements, like update() does for one
+    if rule.percent_change is not None:
+        price_sql = 'GREATEST(ROUND(A.rental_price * (1 + %(percent_change)s / 100), 2), 0)'
+        nights_sql = 'A.id IS NOT NULL'
+    else:
+        price_sql = 'CASE WHEN DAYOFWEEK(S.date) IN (6, 7) THEN %(weekend_price)s ELSE %(weekday_price)s END'
+        nights_sql = ' AND '.join(
+            [
+                *(['DAYOFWEEK(S.date) IN (6, 7)'] if rule.weekday_price is None else []),
+                *(['DAYOFWEEK(S.date) NOT IN (6, 7)'] if rule.weekend_price is None else []),
+            ] or ['TRUE']
+        )
+
+    with transaction(), temporary_table('RepricedSlots', 'slot_id INTEGER PRIMARY KEY, rental_price REAL NOT NULL'):
+        repriced = query(
+            f'''
+                INSERT INTO RepricedSlots(slot_id, rental_price)
+                SELECT S.id, {price_sql}
+                FROM BookingSlots S
+                JOIN Listings L ON L.id = S.listing_id
+                LEFT JOIN AvailabilityLive A ON A.slot_id = S.id
+                LEFT JOIN BookingsLive B ON B.availability_id = A.id
+                WHERE
+                    L.owner_id = %(owner_id)s AND
+                    L.id IN ({', '.join(f'%(listing_id_{idx})s' for idx in range(len(listing_ids))) or 'NULL'}) AND
+                    S.date BETWEEN GREATEST(%(start_date)s, CURDATE()) AND %(end_date)s AND
+                    B.id IS NULL AND
+                    {nights_sql}
+            ''',
+            owner_id=session['user_id'],
+            start_date=start_date,
+            end_date=end_date,
+            **rule._asdict(),
+            **{f'listing_id_{idx}': listing_id for (idx, listing_id) in enumerate(listing_ids)}
+        ).rowcount
+
+        query(
+            '''
+                UPDATE Availability A
+                JOIN RepricedSlots R ON R.slot_id = A.slot_id
+                SET
+                    A.retracted = 1
+                WHERE NOT A.retracted
+            '''
+        )
         query(
             '''
                 INSERT INTO Availability(slot_id, rental_price)
-                VALUES (%(id)s, %(rental_price)s)
+                SELECT slot_id, rental_price
+                FROM RepricedSlots
+            '''
+        )
+        price_stats.record_prices('SELECT slot_id, rental_price FROM RepricedSlots')
+        search_index.record_slots('SELECT slot_id FROM RepricedSlots')
+        listing_calendars.refresh_slots('SELECT slot_id FROM RepricedSlots')
+
+    return repriced
+
+@contextmanager
+def selected_slots(listing_ids: Optional[list] = None, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                   slot_ids: Optional[list] = None):
+    # Fills the SelectedSlots temporary table with the current user's future
+    # slots that match every criterion given, for the bulk operations below
+    # (and bookings.cancel_many) to join against
+    conditions = []
+    env = {}
+    if listing_ids is not None:
+        conditions.append(f"S.listing_id IN ({', '.join(f'%(listing_id_{idx})s' for idx in range(len(listing_ids))) or 'NULL'})")
+        env.update({f'listing_id_{idx}': listing_id for (idx, listing_id) in enumerate(listing_ids)})
+    if start_date is not None:
+        conditions.append('S.date >= %(start_date)s')
+        env['start_date'] = start_date
+    if end_date is not None:
+        conditions.append('S.date <= %(end_date)s')
+        env['end_date'] = end_date
+    if slot_ids is not None:
+        conditions.append(f"S.id IN ({', '.join(f'%(slot_id_{idx})s' for idx in range(len(slot_ids))) or 'NULL'})")
+        env.update({f'slot_id_{idx}': slot_id for (idx, slot_id) in enumerate(slot_ids)})
+
+    with temporary_table('SelectedSlots', 'slot_id INTEGER PRIMARY KEY'):
+        query(
+            f'''
+                INSERT INTO SelectedSlots(slot_id)
+                SELECT S.id
+                FROM BookingSlots S
+                JOIN Listings L ON L.id = S.listing_id
+                WHERE
+                    L.owner_id = %(owner_id)s AND
+                    S.date >= CURDATE()
+                    {''.join(f' AND {condition}' for condition in conditions)}
+            ''',
+            owner_id=session['user_id'],
+            **env
+        )
+        yield
+
+def retract_many(**selection) -> int:
+    # Open nights only; booked nights have to be cancelled first
+    with transaction(), selected_slots(**selection):
+        search_index.record_slots('SELECT slot_id FROM SelectedSlots')
+        retracted = query(
+            '''
+                UPDATE Availability A
+                JOIN SelectedSlots X ON X.slot_id = A.slot_id
+                LEFT JOIN BookingsLive B ON B.availability_id = A.id
+                SET
+                    A.retracted = 1
+                WHERE NOT A.retracted AND B.id IS NULL
+            '''
+        ).rowcount
+        listing_calendars.refresh_slots('SELECT slot_id FROM SelectedSlots')
+        return retracted
+
+def delete_many(**selection) -> int:
+    with transaction(), selected_slots(**selection):
+        # Booked nights are kept, as their bookings would go with them
+        query(
+            '''
+                DELETE X
+                FROM SelectedSlots X
+                JOIN AvailabilityLive A ON A.slot_id = X.slot_id
+                JOIN BookingsLive B ON B.availability_id = A.id
+            '''
+        )
+
+        price_stats.forget_slots('SELECT slot_id FROM SelectedSlots')
+        booking_rollups.forget_slots('SELECT slot_id FROM SelectedSlots')
+        search_index.record_slots('SELECT slot_id FROM SelectedSlots')
+        listing_ids = [
+            row.listing_id
+            for row in query('SELECT DISTINCT listing_id FROM BookingSlots S JOIN SelectedSlots X ON X.slot_id = S.id')
+        ]
+        deleted = query(
+            '''
+                DELETE S
+                FROM BookingSlots S
+                JOIN SelectedSlots X ON X.slot_id = S.id
+            '''
+        ).rowcount
+        listing_calendars.refresh_listing_ids(listing_ids)
+        return deleted
+
+def update(**env):
+    with transaction():
+        query(
+            '''
+                UPDATE Availability
+                SET
+                    retracted = 1
+                WHERE slot_id = %(id)s
             ''',
             **env
         )
 
+        if 'rental_price' in env:
+            query(
+                '''
+                    INSERT INTO Availability(slot_id, rental_price)
+                    VALUES (%(id)s, %(rental_price)s)
+                ''',
+                **env
+            )
+            price_stats.record_availability(env['id'], env['rental_price'])
+
+        search_index.record_slots('%(slot_id)s', slot_id=env['id'])
+        listing_calendars.refresh_slots('%(slot_id)s', slot_id=env['id'])
+
 def delete(id):
-    mark_unavailable(id)
-    query(
-        '''
-            DELETE FROM BookingSlots
-            WHERE id = %(id)s
-        ''',
-        id=id
-    )
+    with transaction():
+        mark_unavailable(id)
+        price_stats.forget_slot(id)
+        booking_rollups.forget_slot(id)
+        query(
+            '''
+                DELETE FROM BookingSlots
+                WHERE id = %(id)s
+            ''',
+            id=id
+        )
 
 def mark_unavailable(slot_id):
+    search_index.record_slots('%(slot_id)s', slot_id=slot_id)
     query(
         '''
             UPDATE Availability
@@ -135,3 +343,4 @@ def mark_unavailable(slot_id):
         ''',
         slot_id=slot_id
     )
+    listing_calendars.refresh_slots('%(slot_id)s', slot_id=slot_id)
@@ -1,10 +1,12 @@
 from typing import NamedTuple, Optional
 from datetime import date
 from flask import session
+from mysql.connector import IntegrityError, errorcode
 from wtforms.validators import ValidationError
 
 from . import booking_slots
-from ..db import query
+from .. import booking_rollups, search_index, listing_calendars
+from ..db import query, transaction, retrying_deadlocks
 
 class Bookings(NamedTuple):
     id: int
@@ -32,19 +34,101 @@ def cancellations(slot_id):
     ).fetchall()
 
 def book(availability_id):
-    query(
-        '''
-            INSERT INTO Bookings(availability_id, renter_id, cancelled)
-            VALUES (
-                %(availability_id)s,
-                %(renter_id)s,
-                0
-            )
-        ''',
-        availability_id=availability_id,
-        renter_id=session['user_id']
+    claim([availability_id], session['user_id'])
+
+def book_stay(listing_id, start_date: date, end_date: date) -> int:
+    return claim_stay(listing_id, start_date, end_date, session['user_id'])
+
+# Errors of bookers that kept colliding with others, for views to report
+# rather than fail on
+CONTENTION_ERRORS = (errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT)
+
+def claim(availability_ids: list, renter_id):
+    # Books all of the availabilities for the renter, or none of them. They
+    # are locked in id order first, so that bookers of the same nights (and
+    # hosts retracting them) queue up behind one another instead of both
+    # going through; the unique live_availability_id of Bookings catches
+    # anything that still slips past. The few deadlocks left, e.g. on the
+    # rollups of neighbouring nights, are retried.
+    retrying_deadlocks(lambda: _claim(availability_ids, renter_id))
+
+def _claim(availability_ids: list, renter_id):
+    availability_ids = sorted(set(availability_ids))
+    ids_sql = ', '.join(f'%(availability_id_{idx})s' for idx in range(len(availability_ids))) or 'NULL'
+    ids_env = {f'availability_id_{idx}': availability_id for (idx, availability_id) in enumerate(availability_ids)}
+    unavailable = ValidationError(
+        'That night is no longer available.' if len(availability_ids) == 1
+        else 'Some of those nights are no longer available.'
     )
 
+    with transaction():
+        claimable = query(
+            f'''
+                SELECT A.id, S.listing_id, S.date
+                FROM Availability A
+                JOIN BookingSlots S ON S.id = A.slot_id
+                JOIN Listings L ON L.id = S.listing_id
+                WHERE
+                    A.id IN ({ids_sql}) AND
+                    NOT A.retracted AND
+                    S.date >= CURDATE() AND
+                    L.owner_id <> %(renter_id)s
+                ORDER BY A.id
+                FOR UPDATE OF A
+            ''',
+            renter_id=renter_id,
+            **ids_env
+        ).fetchall()
+        if not availability_ids or len(claimable) != len(availability_ids):
+            raise unavailable
+
+        try:
+            query(
+                f'''
+                    INSERT INTO Bookings(availability_id, renter_id, cancelled)
+                    VALUES {', '.join(f'(%(availability_id_{idx})s, %(renter_id)s, 0)' for idx in range(len(availability_ids)))}
+                ''',
+                renter_id=renter_id,
+                **ids_env
+            )
+        except IntegrityError as e:
+            if e.errno == errorcode.ER_DUP_ENTRY:
+                raise unavailable
+            raise
+
+        booking_rollups.record_bookings(ids_sql, renter_id, **ids_env)
+        search_index.record_slots(f'SELECT slot_id FROM Availability WHERE id IN ({ids_sql})', **ids_env)
+        nights_by_listing = {}
+        for row in claimable:
+            nights_by_listing.setdefault(row.listing_id, []).append(row.date)
+        listing_calendars.close_nights(nights_by_listing)
+
+def claim_stay(listing_id, start_date: date, end_date: date, renter_id) -> int:
+    # Books every night of the listing from start_date to end_date, or none
+    return retrying_deadlocks(lambda: _claim_stay(listing_id, start_date, end_date, renter_id))
+
+def _claim_stay(listing_id, start_date: date, end_date: date, renter_id) -> int:
+    nights = (end_date - start_date).days + 1
+    with transaction():
+        availability_ids = [
+            row.id
+            for row in query(
+                '''
+                    SELECT A.id
+                    FROM BookingSlots S
+                    JOIN AvailabilityLive A ON A.slot_id = S.id
+                    WHERE S.listing_id = %(listing_id)s AND S.date BETWEEN %(start_date)s AND %(end_date)s
+                ''',
+                listing_id=listing_id,
+                start_date=start_date,
+                end_date=end_date
+            )
+        ]
+        if nights < 1 or len(availability_ids) != nights:
+            raise ValidationError('The listing is not open every night of that stay.')
+        _claim(availability_ids, renter_id)
+    return nights
+
 def rentals_for_id(id):
     rental = query(
         '''
@@ -78,16 +162,38 @@ def past_rentals_for_id(id):
     return rental
 
 def delete(slot_id):
-    query(
-        '''
-            UPDATE Bookings
-            SET 
-              cancelled=1
-            WHERE availability_id IN (
-                SELECT id
-                FROM Availability
-                WHERE slot_id = %(slot_id)s
-            )
-        ''',
-        slot_id=slot_id
-    )
+    with transaction():
+        booking_rollups.record_cancellations(slot_id)
+        search_index.record_slots('%(slot_id)s', slot_id=slot_id)
+        query(
+            '''
+                UPDATE Bookings
+                SET 
+                  cancelled=1
+                WHERE availability_id IN (
+                    SELECT id
+                    FROM Availability
+                    WHERE slot_id = %(slot_id)s
+                )
+            ''',
+            slot_id=slot_id
+        )
+        listing_calendars.refresh_slots('%(slot_id)s', slot_id=slot_id)
+
+def cancel_many(**selection) -> int:
+    # Takes the same selection as booking_slots.selected_slots
+    with transaction(), booking_slots.selected_slots(**selection):
+        booking_rollups.record_cancellations_on_slots('SELECT slot_id FROM SelectedSlots')
+        search_index.record_slots('SELECT slot_id FROM SelectedSlots')
+        cancelled = query(
+            '''
+                UPDATE Bookings B
+                JOIN Availability A ON A.id = B.availability_id
+                JOIN SelectedSlots X ON X.slot_id = A.slot_id
+                SET
+                    B.cancelled = 1
+                WHERE NOT B.cancelled
+            '''
+        ).rowcount
+        listing_calendars.refresh_slots('SELECT slot_id FROM SelectedSlots')
+        return cancelled
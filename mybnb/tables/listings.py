@@ -3,8 +3,10 @@ from datetime import date
 from flask import session
 from wtforms.validators import ValidationError
 
-from . import users
-from ..db import query
+from . import users, loaders
+from .. import price_stats, amenities, search_index, search_order, listing_calendars
+from ..geo import KM_PER_DEGREE, bounding_box
+from ..db import query, transaction
 
 class Listing(NamedTuple):
     id: int
@@ -16,6 +18,7 @@ class Listing(NamedTuple):
     lon: float
     type: str
     amenities: str
+    amenity_bits: int
 
 
 def all():
@@ -37,19 +40,25 @@ def owned_by_current_user():
     )
 
 def for_id(id):
+    return _loader().get(id)
+
+def _loader() -> loaders.Loader:
+    return loaders.loader('listings', _fetch)
+
+def _fetch(ids: list):
     return query(
-        '''
+        f'''
             SELECT *
             FROM Listings
-            WHERE id = %(id)s
+            WHERE id IN ({', '.join(f'%(id_{idx})s' for idx in range(len(ids)))})
         ''',
-        id=id
-    ).fetchone()
+        **{f'id_{idx}': id for (idx, id) in enumerate(ids)}
+    )
 
 def create(**env):
     query(
         '''
-            INSERT INTO Listings(owner_id, country, city, postal, address, lat, lon, type, amenities)
+            INSERT INTO Listings(owner_id, country, city, postal, address, lat, lon, type, amenities, amenity_bits)
             VALUES (
                 %(owner_id)s,
 
@@ -62,72 +71,99 @@ def create(**env):
                 LEAST(GREATEST(%(lon)s, -180), 180),
 
                 %(type)s,
-                %(amenities)s
+                %(amenities)s,
+                %(amenity_bits)s
             )
         ''',
+        amenity_bits=amenities.bitmask(amenities.split(env['amenities'])),
         **env
     )
 
 def update(**env):
-    query(
-        '''
-            UPDATE Listings
-            SET
-                country = %(country)s,
-                city = %(city)s,
-                postal = %(postal)s,
-                address = %(address)s,
-
-                lat = LEAST(GREATEST(%(lat)s, -90), 90),
-                lon = LEAST(GREATEST(%(lon)s, -180), 180),
-
-                type = %(type)s,
-                amenities = %(amenities)s
-            WHERE id = %(id)s 
-        ''',
-        **env
-    )
+    with transaction():
+        query(
+            '''
+                UPDATE Listings
+                SET
+                    country = %(country)s,
+                    city = %(city)s,
+                    postal = %(postal)s,
+                    address = %(address)s,
+
+                    lat = LEAST(GREATEST(%(lat)s, -90), 90),
+                    lon = LEAST(GREATEST(%(lon)s, -180), 180),
+
+                    type = %(type)s,
+                    amenities = %(amenities)s,
+                    amenity_bits = %(amenity_bits)s
+                WHERE id = %(id)s 
+            ''',
+            amenity_bits=amenities.bitmask(amenities.split(env['amenities'])),
+            **env
+        )
+
+        # Amenities may have changed, which moves this listing's prices
+        # between the per-amenity statistics
+        price_stats.refresh_listing(env['id'])
+        search_index.record_listings('%(listing_id)s', listing_id=env['id'])
+        _loader().forget(env['id'])
 
 def delete(id):
-    query(
-        '''
-            DELETE FROM Listings
-            WHERE id = %(id)s
-        ''',
-        id=id
-    )
+    with transaction():
+        price_stats.forget_listing(id)
+        search_index.record_listings('%(listing_id)s', listing_id=id)
+        query(
+            '''
+                DELETE FROM Listings
+                WHERE id = %(id)s
+            ''',
+            id=id
+        )
+        _loader().forget(id)
 
-def search(id, filters):
+def filtered_nights_sql(id, filters) -> tuple[str, dict]:
+    # The open nights matching the filters, one row per night, and the
+    # query's parameters
     query_string = '''
             SELECT rental_price, country, city, postal, address, lat, lon,
-                type, amenities, B.id AS slot_id, A.id AS availability_id, date
+                type, amenities, Listings.id AS listing_id, B.id AS slot_id, A.id AS availability_id, date,
+                {distance} AS distance
             FROM Listings
             JOIN BookingSlots B ON B.listing_id = Listings.id
-            JOIN Availability A ON A.slot_id = B.id
+            JOIN AvailabilityLive A ON A.slot_id = B.id
             WHERE owner_id <> %(id)s
             AND NOT EXISTS ( SELECT availability_id FROM Bookings WHERE Bookings.availability_id = A.id AND Bookings.cancelled = 0)
         '''
 
     filter_params = {'id': id}
+    distance = 'NULL'
+    nearest = None
     if filters:
         filter_conditions = []
-        sort = ""
         for idx, (filter_name, filter_value, filter_sign) in enumerate(filters):
             if filter_name == "postal":
                 filter_conditions.append(f"LEFT({filter_name},3) {filter_sign} %(filter_{idx})s")
                 filter_params[f'filter_{idx}'] = filter_value
             elif filter_name == "sort":
-                if filter_value == "Low To High":
-                    sort += f" ORDER BY rental_price ASC"
-                elif filter_value == "High To Low":
-                    sort += f" ORDER BY rental_price DESC"
+                # See search_order.sort_keys
+                pass
             elif filter_name == "type":
                 if filter_value != "None":
                     filter_conditions.append(f"{filter_name} {filter_sign} %(filter_{idx})s")
                     filter_params[f'filter_{idx}'] = filter_value
             elif filter_name == "distance":
+                (lat, lon, max_distance) = filter_value
 
-                distance = f"111.111 \
+                # Listings outside the bounding box are ruled out on the
+                # (lat, lon) index before any exact distance is computed
+                (lat_range, lon_range) = bounding_box(lat, lon, max_distance)
+                filter_conditions.append(f"lat BETWEEN %(filter_{idx}_min_lat)s AND %(filter_{idx}_max_lat)s")
+                filter_params[f'filter_{idx}_min_lat'], filter_params[f'filter_{idx}_max_lat'] = lat_range
+                if lon_range:
+                    filter_conditions.append(f"lon BETWEEN %(filter_{idx}_min_lon)s AND %(filter_{idx}_max_lon)s")
+                    filter_params[f'filter_{idx}_min_lon'], filter_params[f'filter_{idx}_max_lon'] = lon_range
+
+                distance = f"{KM_PER_DEGREE} \
                     * DEGREES(ACOS(LEAST(1.0, COS(RADIANS(lat))\
                     * COS(RADIANS(%(filter_{idx}_lat)s))\
                     * COS(RADIANS(lon - %(filter_{idx}_lon)s))\
@@ -135,24 +171,86 @@ def search(id, filters):
                     * SIN(RADIANS(%(filter_{idx}_lat)s)))))"
                 distance_condition = f"({distance} {filter_sign} %(filter_{idx}_distance)s)"
                 filter_conditions.append(distance_condition)
-                filter_params[f'filter_{idx}_lat'] = filter_value[0]
-                filter_params[f'filter_{idx}_lon'] = filter_value[1]
-                filter_params[f'filter_{idx}_distance'] = filter_value[2]
+                filter_params[f'filter_{idx}_lat'] = lat
+                filter_params[f'filter_{idx}_lon'] = lon
+                filter_params[f'filter_{idx}_distance'] = max_distance
 
-                sort = f"{sort}, {distance} DESC" if sort else f" ORDER BY {distance} DESC"
+            elif filter_name == "nearest":
+                # Only the given number of nearest listings, with all of their
+                # matching nights
+                nearest = filter_value
+                filter_params['nearest'] = filter_value
 
             elif filter_name == "amenities":
-                for amenity in filter_value:
-                    filter_conditions.append(f"amenities {filter_sign} %(filter_{idx}_{amenity})s")
-                    filter_params[f'filter_{idx}_{amenity}'] = f"%{amenity}%"
+                # Listings having every selected amenity
+                filter_conditions.append(f"(amenity_bits & %(filter_{idx})s) = %(filter_{idx})s")
+                filter_params[f'filter_{idx}'] = amenities.bitmask(filter_value)
+            elif filter_name == "stay":
+                # Listings open every night of the range, whatever the other
+                # filters make of those nights
+                (stay_sql, stay_params) = listing_calendars.stay_sql(
+                    'Listings.id', *map(date.fromisoformat, filter_value), prefix=f'filter_{idx}'
+                )
+                filter_conditions.append(stay_sql)
+                filter_params.update(stay_params)
             else:
                 filter_conditions.append(f"{filter_name} {filter_sign} %(filter_{idx})s")
                 filter_params[f'filter_{idx}'] = filter_value
         if filter_conditions:
             filter_string = " AND ".join(filter_conditions)
             query_string += f" AND {filter_string}" 
-        if not sort:
-            sort = " ORDER BY date"
-        query_string += sort
-    
-    return query(query_string, **filter_params).fetchall()
+
+        if nearest and distance != 'NULL':
+            query_string = f'''
+                SELECT *
+                FROM (
+                    SELECT R.*, DENSE_RANK() OVER (ORDER BY distance, listing_id) AS listing_rank
+                    FROM ({query_string}) R
+                ) R
+                WHERE listing_rank <= %(nearest)s
+            '''
+
+    return query_string.replace('{distance}', distance), filter_params
+
+def search(id, filters, after: Optional[str] = None, limit: Optional[int] = None) -> search_order.SearchPage:
+    (nights_sql, params) = filtered_nights_sql(id, filters)
+    return search_page(nights_sql, params, search_order.sort_keys(filters), after, limit)
+
+def search_grouped(id, filters, after: Optional[str] = None, limit: Optional[int] = None) -> search_order.SearchPage:
+    # One row per listing with matching nights, summing those nights up
+    (nights_sql, params) = filtered_nights_sql(id, filters)
+    listings_sql = f'''
+        SELECT
+            listing_id,
+            ANY_VALUE(country) AS country, ANY_VALUE(city) AS city, ANY_VALUE(postal) AS postal,
+            ANY_VALUE(address) AS address, ANY_VALUE(lat) AS lat, ANY_VALUE(lon) AS lon,
+            ANY_VALUE(type) AS type, ANY_VALUE(amenities) AS amenities, MIN(distance) AS distance,
+            MIN(rental_price) AS min_price, MAX(rental_price) AS max_price, SUM(rental_price) AS total_price,
+            COUNT(*) AS nights,
+            COALESCE(COUNT(*) = %(window_nights)s, FALSE) AS every_night
+        FROM ({nights_sql}) N
+        GROUP BY listing_id
+    '''
+    return search_page(
+        listings_sql, {**params, 'window_nights': search_order.window_nights(filters)},
+        search_order.grouped_sort_keys(filters), after, limit
+    )
+
+def search_page(rows_sql: str, params: dict, keys: list, after: Optional[str], limit: Optional[int]) -> search_order.SearchPage:
+    # One page in sort key order, starting after the cursor
+    limit = search_order.page_size(limit)
+    cursor = search_order.decode_cursor(after, keys)
+    (keyset, keyset_params) = search_order.keyset_sql(keys, cursor) if cursor else ('TRUE', {})
+    rows = query(
+        f'''
+            SELECT *
+            FROM ({rows_sql}) P
+            WHERE {keyset}
+            ORDER BY {', '.join(f"{key.column} {'DESC' if key.descending else 'ASC'}" for key in keys)}
+            LIMIT %(limit)s
+        ''',
+        limit=limit + 1,
+        **params,
+        **keyset_params
+    ).fetchall()
+    return search_order.page(rows, keys, limit)
@@ -0,0 +1,53 @@
+from typing import Callable, Iterable, Optional
+
+from flask import g, has_app_context
+
+class Loader:
+    # Rows of one table by id for the rest of the request (an identity map).
+    # Ids passed to want() are fetched together, with one query, by the next
+    # lookup of an id that isn't loaded yet.
+    def __init__(self, fetch_many: Callable[[list], Iterable]):
+        self.fetch_many = fetch_many
+        self.rows = {}
+        self.wanted = set()
+
+    def want(self, ids: Iterable):
+        self.wanted.update(id for id in map(_row_id, ids) if id is not None and id not in self.rows)
+
+    def get(self, id):
+        # None if there is no such row
+        return self.get_many([id])[0]
+
+    def get_many(self, ids: Iterable) -> list:
+        ids = [_row_id(id) for id in ids]
+        self.want(ids)
+        if self.wanted:
+            wanted = sorted(self.wanted)
+            self.wanted.clear()
+
+            found = {row.id: row for row in self.fetch_many(wanted)}
+            self.rows.update((id, found.get(id)) for id in wanted)
+        return [self.rows.get(id) for id in ids]
+
+    def forget(self, id):
+        # After the row was written to
+        self.rows.pop(_row_id(id), None)
+
+def _row_id(id) -> Optional[int]:
+    # Ids often come straight from the URL; one that isn't a number matches
+    # no row
+    try:
+        return int(id)
+    except (TypeError, ValueError):
+        return None
+
+def loader(name: str, fetch_many: Callable[[list], Iterable]) -> Loader:
+    # Outside of requests (scripts, benchmarks) there is nothing to scope the
+    # identity map to, so every lookup gets a fresh one
+    if not has_app_context():
+        return Loader(fetch_many)
+
+    loaders = g.setdefault('loaders', {})
+    if name not in loaders:
+        loaders[name] = Loader(fetch_many)
+    return loaders[name]
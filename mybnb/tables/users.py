@@ -1,9 +1,11 @@
 from typing import NamedTuple, Optional
 from datetime import date
-from flask import session
+from flask import g, session
 from wtforms.validators import ValidationError
 
-from ..db import query
+from . import loaders
+from .. import price_stats, search_index, listing_calendars, sessions
+from ..db import query, transaction
 
 class User(NamedTuple):
     id: int
@@ -31,36 +33,69 @@ def current() -> User:
             is_host=False
         )
 
-    user = query(
-        '''
-            SELECT
-                U.id, U.sin, U.username, U.name, U.dob, U.address, U.occupation,
-                COUNT(R.user_id) AS is_renter, COUNT(H.user_id) AS is_host
-            FROM Users U
-            LEFT JOIN Renters R ON R.user_id = U.id
-            LEFT JOIN Hosts H ON H.user_id = U.id
-            WHERE id = %(id)s
-        ''',
-        id=session['user_id']
-    ).fetchone()
+    # Looked up once per request; the renter and host flags are kept in the
+    # session, as they only change through become_renter and become_host
+    # (or when another session of the same user calls them)
+    user = g.get('current_user')
+    if user is None or user.id != session['user_id']:
+        user = g.current_user = _load_current()
+    return user
+
+def _load_current() -> Optional[User]:
+    # Through the loader if the roles aren't known yet, or if the view wants
+    # other users too, so that they are all fetched with one query
+    roles = session.get('user_roles')
+    if roles is None or _loader().wanted:
+        user = for_id(session['user_id'])
+        if user:
+            session['user_roles'] = [bool(user.is_renter), bool(user.is_host)]
+    else:
+        row = query(
+            '''
+                SELECT id, sin, username, name, dob, address, occupation
+                FROM Users
+                WHERE id = %(id)s
+            ''',
+            id=session['user_id']
+        ).fetchone()
+        user = User(*row, is_renter=roles[0], is_host=roles[1]) if row else None
 
     if not user:
         del session['user_id']
+        session.pop('user_roles', None)
     return user
 
+def _forget_current():
+    # After anything current() returns has changed
+    g.pop('current_user', None)
+    session.pop('user_roles', None)
+    if 'user_id' in session:
+        _loader().forget(session['user_id'])
+
 def for_id(id) -> User:
+    return _loader().get(id)
+
+def want(ids):
+    # Users about to be looked up, to be fetched with the next lookup
+    _loader().want(ids)
+
+def _loader() -> loaders.Loader:
+    return loaders.loader('users', _fetch)
+
+def _fetch(ids: list):
     return query(
-        '''
+        f'''
             SELECT
                 U.id, U.sin, U.username, U.name, U.dob, U.address, U.occupation,
                 COUNT(R.user_id) AS is_renter, COUNT(H.user_id) AS is_host
             FROM Users U
             LEFT JOIN Renters R ON R.user_id = U.id
             LEFT JOIN Hosts H ON H.user_id = U.id
-            WHERE id = %(id)s
+            WHERE id IN ({', '.join(f'%(id_{idx})s' for idx in range(len(ids)))})
+            GROUP BY U.id
         ''',
-        id=id
-    ).fetchone()
+        **{f'id_{idx}': id for (idx, id) in enumerate(ids)}
+    )
 
 def sign_up(**env):
     query(
@@ -92,7 +127,9 @@ def log_in(**env):
     if not user:
         raise ValidationError(f"User {env['username']} does not exist.")
 
+    sessions.rotate_id()
     session['user_id'] = user.id
+    _forget_current()
 
 def become_renter(card_num):
     if 'user_id' not in session:
@@ -106,6 +143,7 @@ def become_renter(card_num):
         user_id=session['user_id'],
         card_num=card_num
     )
+    _forget_current()
 
 def become_host():
     if 'user_id' not in session:
@@ -118,6 +156,7 @@ def become_host():
         ''',
         user_id=session['user_id']
     )
+    _forget_current()
 
 def update_profile(**env):
     if 'user_id' not in session:
@@ -140,15 +179,45 @@ def update_profile(**env):
             'id': session['user_id']
         }
     )
+    _forget_current()
 
 def delete_current():
     if 'user_id' not in session:
         raise ValidationError('You are browsing as a demo user; please log in to continue.')
-    
-    query(
-        '''
-            DELETE FROM Users
-            WHERE id = %(id)s
-        ''',
-        id=session['user_id']
-    )
+
+    with transaction():
+        price_stats.forget_listings_owned_by(session['user_id'])
+
+        # The user's listings go away, and the nights they had booked open up
+        search_index.record_listings('SELECT id FROM Listings WHERE owner_id = %(user_id)s', user_id=session['user_id'])
+        search_index.record_slots(
+            '''
+                SELECT A.slot_id
+                FROM Availability A
+                JOIN BookingsLive B ON B.availability_id = A.id
+                WHERE B.renter_id = %(user_id)s
+            ''',
+            user_id=session['user_id']
+        )
+        booked_listing_ids = [
+            row.listing_id
+            for row in query(
+                '''
+                    SELECT DISTINCT S.listing_id
+                    FROM BookingSlots S
+                    JOIN Availability A ON A.slot_id = S.id
+                    JOIN BookingsLive B ON B.availability_id = A.id
+                    WHERE B.renter_id = %(user_id)s
+                ''',
+                user_id=session['user_id']
+            )
+        ]
+        query(
+            '''
+                DELETE FROM Users
+                WHERE id = %(id)s
+            ''',
+            id=session['user_id']
+        )
+        listing_calendars.refresh_listing_ids(booked_listing_ids)
+    _forget_current()
@@ -1,6 +1,6 @@
 -- CSCC43 Project Schema
 
--- Listings(_id_, country, city, postal, address, lat, lon, type, amenities)
+-- Listings(_id_, country, city, postal, address, lat, lon, type, amenities, amenity_bits)
 
 -- Users(_id_, sin, name, address, dob, occupation)
 -- Hosts(_user_id_)
@@ -14,6 +14,16 @@
 -- ListingComments(_renter_id_, _listing_id_, comment, rating)
 -- UserComments(_renter_id_, _host_id_, renter_comment, renter_rating, host_comment, host_rating)
 
+-- AmenityPriceTotals(_amenity_, bit, weighted_sum, count)
+-- AmenityPriceContributions(_listing_id_, _amenity_, weighted_sum, count)
+-- BookingRollups(_date_, _listing_id_, _renter_id_, _cancelled_, count)
+-- DataVersion(version)
+-- ListingCommentNouns(_renter_id_, _listing_id_, content_hash, nouns)
+-- ListingCommentNounCounts(_noun_, count)
+-- SearchIndexChanges(_id_, listing_id, changed_at)
+-- ListingCalendars(_listing_id_, starts_on, open_nights)
+-- Sessions(_id_, data, expires_at)
+
 CREATE DATABASE IF NOT EXISTS mybnb;
 USE mybnb;
 
@@ -54,8 +64,14 @@ CREATE TABLE Listings (
   lon REAL NOT NULL,
   type VARCHAR(31) NOT NULL,
   amenities VARCHAR(255) NOT NULL,
+  -- Bit i set iff amenities includes AMENITIES_CHOICES[i] (see mybnb/amenities.py)
+  amenity_bits BIGINT UNSIGNED NOT NULL DEFAULT 0,
 
-  FOREIGN KEY (owner_id) REFERENCES Hosts(user_id) ON DELETE CASCADE
+  FOREIGN KEY (owner_id) REFERENCES Hosts(user_id) ON DELETE CASCADE,
+  -- Bounding box prefilter of the listings search
+  INDEX ListingsLocation (lat, lon),
+  -- Listing counts and per-city sections of the reports
+  INDEX ListingsPlace (country, city, postal)
 );
 
 CREATE TABLE BookingSlots (
@@ -64,7 +80,9 @@ CREATE TABLE BookingSlots (
   date DATE NOT NULL,
 
   FOREIGN KEY (listing_id) REFERENCES Listings(id) ON DELETE CASCADE,
-  UNIQUE (listing_id, date)
+  UNIQUE (listing_id, date),
+  -- Date filters of the listings search and rolling the calendars
+  INDEX BookingSlotsDate (date)
 );
 
 CREATE TABLE Availability (
@@ -73,6 +91,8 @@ CREATE TABLE Availability (
   rental_price REAL NOT NULL,
   retracted BOOLEAN DEFAULT 0,
 
+  -- Also serves the foreign key; live availability of a slot
+  INDEX AvailabilitySlot (slot_id, retracted),
   FOREIGN KEY (slot_id) REFERENCES BookingSlots(id) ON DELETE CASCADE
 );
 CREATE VIEW AvailabilityLive AS
@@ -85,9 +105,17 @@ CREATE TABLE Bookings (
   availability_id INTEGER NOT NULL,
   renter_id INTEGER NOT NULL,
   cancelled BOOLEAN DEFAULT 0,
+  -- The availability while the booking is live, so that it can only have
+  -- one live booking at a time (see bookings.claim)
+  live_availability_id INTEGER AS (IF(cancelled, NULL, availability_id)) VIRTUAL,
 
+  -- Also serve the foreign keys; live (or cancelled) bookings of a night
+  -- and of a renter
+  INDEX BookingsAvailability (availability_id, cancelled),
+  INDEX BookingsRenter (renter_id, cancelled),
   FOREIGN KEY (availability_id) REFERENCES Availability(id) ON DELETE CASCADE,
-  FOREIGN KEY (renter_id) REFERENCES Renters(user_id) ON DELETE CASCADE
+  FOREIGN KEY (renter_id) REFERENCES Renters(user_id) ON DELETE CASCADE,
+  UNIQUE BookingsLiveAvailability (live_availability_id)
 );
 CREATE VIEW BookingsLive AS
 SELECT *
@@ -123,3 +151,118 @@ CREATE TABLE UserComments (
   host_comment VARCHAR(511),
   host_rating REAL
 );
+
+-- Host toolkit statistics; see mybnb/price_stats.py
+
+CREATE TABLE AmenityPriceTotals (
+  amenity VARCHAR(31) PRIMARY KEY,
+  bit BIGINT UNSIGNED NOT NULL,
+  weighted_sum REAL NOT NULL,
+  count INTEGER NOT NULL
+);
+
+CREATE TABLE AmenityPriceContributions (
+  listing_id INTEGER,
+  amenity VARCHAR(31),
+  PRIMARY KEY (listing_id, amenity),
+
+  FOREIGN KEY (listing_id) REFERENCES Listings(id) ON DELETE CASCADE,
+  FOREIGN KEY (amenity) REFERENCES AmenityPriceTotals(amenity) ON DELETE CASCADE,
+
+  weighted_sum REAL NOT NULL,
+  count INTEGER NOT NULL
+);
+
+-- Booking report rollups; see mybnb/booking_rollups.py
+
+CREATE TABLE BookingRollups (
+  date DATE,
+  listing_id INTEGER,
+  renter_id INTEGER,
+  cancelled BOOLEAN,
+  PRIMARY KEY (date, listing_id, renter_id, cancelled),
+
+  FOREIGN KEY (listing_id) REFERENCES Listings(id) ON DELETE CASCADE,
+  FOREIGN KEY (renter_id) REFERENCES Renters(user_id) ON DELETE CASCADE,
+
+  count INTEGER NOT NULL
+);
+
+-- Incremented after every request that writes; see mybnb/db.py
+
+CREATE TABLE DataVersion (
+  version BIGINT NOT NULL
+);
+INSERT INTO DataVersion(version) VALUES (0);
+
+-- Noun phrase report cache; see mybnb/comment_nouns.py
+
+CREATE TABLE ListingCommentNouns (
+  renter_id INTEGER,
+  listing_id INTEGER,
+  PRIMARY KEY (renter_id, listing_id),
+
+  content_hash CHAR(64) NOT NULL,
+  nouns TEXT NOT NULL
+);
+
+CREATE TABLE ListingCommentNounCounts (
+  noun VARCHAR(511) COLLATE utf8mb4_bin PRIMARY KEY,
+  count INTEGER NOT NULL
+);
+
+-- Listings whose open availability changed, for the in-process search
+-- indexes to catch up with; see mybnb/search_index.py
+
+CREATE TABLE SearchIndexChanges (
+  id BIGINT PRIMARY KEY AUTO_INCREMENT,
+  listing_id INTEGER NOT NULL,
+  changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+  INDEX (changed_at)
+);
+
+-- Bitmap per listing of its open nights from starts_on on, for stays over
+-- a date range; see mybnb/listing_calendars.py
+
+CREATE TABLE ListingCalendars (
+  listing_id INTEGER PRIMARY KEY,
+  starts_on DATE NOT NULL,
+  -- HORIZON_DAYS / 8 bytes
+  open_nights BINARY(48) NOT NULL,
+
+  FOREIGN KEY (listing_id) REFERENCES Listings(id) ON DELETE CASCADE,
+  INDEX (starts_on)
+);
+
+-- Server-side sessions when MYBNB_SESSION_STORE=database; see mybnb/sessions.py
+
+CREATE TABLE Sessions (
+  id VARCHAR(63) PRIMARY KEY,
+  data BLOB NOT NULL,
+  -- UTC
+  expires_at DATETIME NOT NULL,
+
+  INDEX (expires_at)
+);
+
+-- Reports generated in the background, shared by every worker for polling
+-- and reuse; see mybnb/background_reports.py
+
+CREATE TABLE BackgroundReports (
+  id CHAR(32) PRIMARY KEY,
+  start_date DATE NOT NULL,
+  end_date DATE NOT NULL,
+  data_version BIGINT NOT NULL,
+  -- UTC
+  submitted_at DATETIME(6) NOT NULL,
+  updated_at DATETIME(6) NOT NULL,
+  -- JSON, [{title, done, seconds}, ...]
+  sections TEXT NOT NULL,
+  -- JSON, once done
+  report LONGTEXT,
+  error VARCHAR(1023),
+
+  INDEX (start_date, end_date, data_version),
+  INDEX (submitted_at)
+);
@@ -2,6 +2,16 @@
 
 USE mybnb;
 
+DROP TABLE IF EXISTS BackgroundReports;
+DROP TABLE IF EXISTS Sessions;
+DROP TABLE IF EXISTS ListingCalendars;
+DROP TABLE IF EXISTS SearchIndexChanges;
+DROP TABLE IF EXISTS ListingCommentNounCounts;
+DROP TABLE IF EXISTS ListingCommentNouns;
+DROP TABLE IF EXISTS DataVersion;
+DROP TABLE IF EXISTS BookingRollups;
+DROP TABLE IF EXISTS AmenityPriceContributions;
+DROP TABLE IF EXISTS AmenityPriceTotals;
 DROP TABLE IF EXISTS Bookings;
 DROP TABLE IF EXISTS Availability;
 DROP VIEW IF EXISTS AvailabilityLive;